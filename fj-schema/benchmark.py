@@ -0,0 +1,109 @@
+#!/usr/bin/python3.6
+#coding: utf-8
+
+'''
+Compare the compiled validator of JSchema0 in example.py with walking its
+schema objects through verify(). Both must give the same result for every
+sample, valid or not, before their speed is compared.
+
+    python3 benchmark.py [-n NUMBER]
+'''
+
+import copy
+import random
+import timeit
+import argparse
+
+from example import JSchema0
+
+
+VALID = {
+    'attr_str': 'a' * 64,
+    'attr_int': 42,
+    'some_objects': ['SomeRegex'] * 5,
+    'nested_json': {
+        'attr0': 'nested',
+        'attr1': 50,
+        'attr2': 0.5,
+    },
+}
+
+# replacement values tried on every field, covering wrong types, None,
+# out of range numbers, too long strings and arrays and regex mismatches
+CANDIDATES = [
+    None, True, 0, -1, 101, 0.05, 0.95, 0.5, '', 'SomeRegex', 'other',
+    'x' * 200, [], ['SomeRegex'] * 11, ['other'], [1], {}, {'attr0': 1},
+]
+
+PATHS = [
+    ('attr_str', ),
+    ('attr_int', ),
+    ('some_objects', ),
+    ('nested_json', ),
+    ('nested_json', 'attr0'),
+    ('nested_json', 'attr1'),
+    ('nested_json', 'attr2'),
+]
+
+
+def replaced(path, candidate):
+    sample = copy.deepcopy(VALID)
+    target = sample
+    for key in path[:-1]:
+        target = target[key]
+    target[path[-1]] = candidate
+    return sample
+
+
+def make_samples(count, seed=0):
+    ''' Every single replacement, then random combinations of them '''
+
+    samples = [VALID, None, [], 'string']
+    samples += [replaced(path, candidate) for path in PATHS for candidate in CANDIDATES]
+
+    rng = random.Random(seed)
+    for i in range(count):
+        sample = copy.deepcopy(VALID)
+        for path in rng.sample(PATHS, 2):
+            target = sample
+            for key in path[:-1]:
+                target = target[key] if isinstance(target, dict) else {}
+            if isinstance(target, dict):
+                target[path[-1]] = rng.choice(CANDIDATES)
+        samples.append(sample)
+    return samples
+
+
+def outcome(verify, sample):
+    try:
+        verify(sample)
+    except Exception as e:
+        return type(e)
+    return None
+
+
+if __name__ == '__main__':
+    argp = argparse.ArgumentParser(description=__doc__)
+    argp.add_argument('-n', default=20000, type=int, help='calls per measurement')
+    args = argp.parse_args()
+
+    interpreted = JSchema0.schema.verify
+    compiled = JSchema0.validator
+
+    samples = make_samples(1000)
+    for sample in samples:
+        expected = outcome(interpreted, sample)
+        actual = outcome(compiled, sample)
+        if expected is not actual:
+            raise SystemExit(f'results differ on {sample!r}: {expected} != {actual}')
+    print(f'{len(samples)} samples, same results')
+
+    invalid = replaced(('nested_json', 'attr2'), 0.95)
+    for label, sample in [('valid', VALID), ('invalid', invalid)]:
+        times = {}
+        for name, verify in [('interpreted', interpreted), ('compiled', compiled)]:
+            timer = timeit.Timer(lambda: outcome(verify, sample))
+            times[name] = min(timer.repeat(5, args.n)) / args.n * 1e6
+        print(f'{label:8s} interpreted {times["interpreted"]:7.2f} us'
+              f'  compiled {times["compiled"]:7.2f} us'
+              f'  speedup {times["interpreted"] / times["compiled"]:5.1f}x')
@@ -1,15 +1,23 @@
 #!/usr/bin/python3.6
 #coding: utf-8
 
+from .compiler import compile_schema
+
 
 class BaseSchema():
 
     ''' The base class of all schema class
     '''
 
+    # the schema compiled by MetaSchema when the class is created
+    validator = None
+
     @classmethod
     def verify(cls, value):
-        cls.schema.verify(value)
+        if cls.validator is None:
+            cls.schema.verify(value)
+        else:
+            cls.validator(value)
 
 
 class MetaSchema(type):
@@ -17,7 +25,8 @@ class MetaSchema(type):
     ''' metaclass of all schema class
 
     Once use this class as a meta class, it will make your class inherit
-    the BaseSchema class above and register your class in JsonSchemaValidator
+    the BaseSchema class above, compile its schema into a single validator
+    function and register your class in JsonSchemaValidator
     '''
 
     def __new__(mcls, name, bases, attrs, **kwargs):
@@ -34,6 +43,10 @@ class MetaSchema(type):
                 'json schema class %s dosn\'t defined "route"' % name
             )
 
+        schema = attrs.get('schema')
+        if schema is not None:
+            cls.validator = staticmethod(compile_schema(schema, f'validate_{name}'))
+
         JsonSchemaValidator.register(route, cls)
 
 
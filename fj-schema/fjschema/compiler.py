@@ -0,0 +1,158 @@
+#!/usr/bin/python3.6
+#coding: utf-8
+
+import re
+
+from werkzeug.exceptions import (
+    BadRequest,
+    UnprocessableEntity,
+)
+
+from .types import (
+    Float,
+    Integer,
+    String,
+    Boolean,
+    Array,
+    ContainerArray,
+    Json,
+)
+
+
+class _Compiler():
+
+    ''' Generate the source of one function that verifies a whole schema
+
+    The checks are the same as the verify methods in types.py, in the same
+    order, but unrolled: bounds that are None produce no code at all and
+    every object the code needs (types, bounds, compiled regexes) is bound
+    as a closure variable.
+    '''
+
+    def __init__(self):
+        self.lines = []
+        self.consts = {}
+        self.counter = 0
+
+    def const(self, obj):
+        name = f'c{len(self.consts)}'
+        self.consts[name] = obj
+        return name
+
+    def var(self):
+        self.counter += 1
+        return f'v{self.counter}'
+
+    def emit(self, indent, line):
+        self.lines.append('    ' * indent + line)
+
+    def compile(self, jtype, value, indent):
+        generator = self.GENERATORS.get(type(jtype))
+
+        # subclasses defined by users may override verify, keep calling it
+        if generator is None:
+            self.emit(indent, f'{self.const(jtype)}.verify({value})')
+            return
+
+        if jtype.nullable:
+            self.emit(indent, f'if {value} is not None:')
+            indent += 1
+
+        self.emit(indent, f'if not isinstance({value}, {self.const(jtype.PY_TYPE)}):')
+        self.emit(indent + 1, 'raise BadRequest')
+        generator(self, jtype, value, indent)
+
+    def compile_bounds(self, jtype, size, indent):
+        if jtype.minimum is not None:
+            self.emit(indent, f'if {size} < {self.const(jtype.minimum)}:')
+            self.emit(indent + 1, 'raise UnprocessableEntity')
+        if jtype.maximum is not None:
+            self.emit(indent, f'if {size} > {self.const(jtype.maximum)}:')
+            self.emit(indent + 1, 'raise UnprocessableEntity')
+
+    def compile_len(self, jtype, value, indent):
+        # the minimum is not checked for None, like the verify_value methods
+        if jtype.maximum is None:
+            return
+
+        minimum = self.const(jtype.minimum)
+        maximum = self.const(jtype.maximum)
+        self.emit(indent, f'if not {minimum} <= len({value}) <= {maximum}:')
+        self.emit(indent + 1, 'raise UnprocessableEntity')
+
+    def compile_float(self, jtype, value, indent):
+        self.compile_bounds(jtype, value, indent)
+
+    def compile_string(self, jtype, value, indent):
+        self.compile_len(jtype, value, indent)
+
+        if jtype.schema is not None:
+            pattern = self.const(re.compile(jtype.schema))
+            self.emit(indent, f'if not {pattern}.match({value}):')
+            self.emit(indent + 1, 'raise UnprocessableEntity')
+
+    def compile_boolean(self, jtype, value, indent):
+        pass
+
+    def compile_array(self, jtype, value, indent):
+        self.compile_len(jtype, value, indent)
+
+        if jtype.array_schema is None:
+            return
+
+        # zip() in verify_array stops at the shorter one
+        for i, item_type in enumerate(jtype.array_schema):
+            item = self.var()
+            self.emit(indent, f'if len({value}) > {i}:')
+            self.emit(indent + 1, f'{item} = {value}[{i}]')
+            self.compile(item_type, item, indent + 1)
+
+    def compile_container_array(self, jtype, value, indent):
+        self.compile_len(jtype, value, indent)
+
+        item = self.var()
+        self.emit(indent, f'for {item} in {value}:')
+        self.compile(jtype.item_schema, item, indent + 1)
+
+    def compile_json(self, jtype, value, indent):
+        for name, field_type in jtype.json_schema.items():
+            field = self.var()
+            self.emit(indent, f'{field} = {value}.get({name!r})')
+            self.compile(field_type, field, indent)
+
+    GENERATORS = {
+        Float: compile_float,
+        Integer: compile_float,
+        String: compile_string,
+        Boolean: compile_boolean,
+        Array: compile_array,
+        ContainerArray: compile_container_array,
+        Json: compile_json,
+    }
+
+
+def compile_schema(jtype, name='validate'):
+    ''' Compile a json type into a function that takes the value to verify
+
+    The function raises the same exceptions as jtype.verify does for every
+    value, its generated source is kept in the "source" attribute.
+    '''
+
+    compiler = _Compiler()
+    compiler.compile(jtype, 'value', 2)
+
+    # the constants are unpacked into locals of make() so that the validator
+    # reads them from its closure, there may be more than 255 of them
+    source = '\n'.join(
+        ['def make(BadRequest, UnprocessableEntity, consts):']
+        + [f'    {const} = consts[{const!r}]' for const in compiler.consts]
+        + [f'    def {name}(value):']
+        + compiler.lines
+        + [f'    return {name}']
+    )
+
+    namespace = {}
+    exec(compile(source, f'<fjschema {name}>', 'exec'), namespace)
+    function = namespace['make'](BadRequest, UnprocessableEntity, compiler.consts)
+    function.source = source
+    return function
@@ -1,16 +1,40 @@
 #!/usr/bin/env python3
 #coding:utf-8
 import io
+import os
+import copy
 import sys
+import lzma
+import mmap
+import json
+import stat
+import hashlib
+import time
+import zlib
+import heapq
+import struct
 import base64 as b64
 import argparse
 
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import deque
+
 from Crypto.PublicKey import RSA
-from Crypto.Cipher import PKCS1_OAEP
+from Crypto.Cipher import PKCS1_OAEP, AES, ChaCha20_Poly1305
 from Crypto.Hash import SHA256
-from threading import Thread, Event, Lock
-from multiprocessing import Process, Queue
+from Crypto.Protocol.KDF import HKDF
+from Crypto.Random import get_random_bytes
+from queue import Queue as LocalQueue
+from threading import Thread, Lock, Event, Condition as LocalCondition, local
+from multiprocessing import Process, Queue, Condition, Value, Array
 from multiprocessing.queues import Empty
+from multiprocessing.shared_memory import SharedMemory
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
 
 '''
@@ -37,16 +61,71 @@ from multiprocessing.queues import Empty
 class SourceFile(object):
     serial = 0
     buffer_ = None
-
-    def __init__(self, source_file, bs=None):
-        self.__file = open(source_file, 'rb')
+    # 加密时输入为空也输出一个空的数据块，带结束标记的加密类型需要它
+    empty_block = False
+
+    def __init__(self, source_file, bs=None, plain_range=None, opt_type='decrypt'):
+        # '-'表示从标准输入读取
+        if source_file == '-':
+            self.__file = sys.stdin.buffer
+        else:
+            self.__file = open(source_file, 'rb')
         self.bs = bs or 64
+        # 缓冲读取时一次读入的数据块(或行)数量，None时一次读入32M(或32000行)
+        self.buffer_blocks = None
+        # 组batch时多读出来的一块数据，留给下一个batch
+        self.__peeked = None
+        self.eof = False
+        # 解密时下一个按行对齐的区间的起始位置
+        self.__span_offset = 0
+
+        # block模式下使用内存映射，master只分发(offset, length)，
+        # worker直接从映射中切片，父进程中不再有任何拷贝。
+        # 映射在fork出worker之前建立，worker进程会继承它
+        self.mmap_ = None
+        file_stat = os.fstat(self.__file.fileno())
+        self.size = file_stat.st_size
+        # 普通文件的大小在开始前就是确定的
+        self.regular = stat.S_ISREG(file_stat.st_mode)
+        if self.size > 0:
+            try:
+                self.mmap_ = mmap.mmap(self.__file.fileno(), 0, access=mmap.ACCESS_READ)
+            except (OSError, ValueError):
+                # 无法映射的文件(如管道)仍然走缓冲读取
+                pass
+            else:
+                if hasattr(mmap, 'MADV_SEQUENTIAL'):
+                    self.mmap_.madvise(mmap.MADV_SEQUENTIAL)
+
+        # 容器格式的文件，解密时按索引把一段段record分发给worker
+        # plain_range为(start, length)时只解密明文中的这一段
+        # 加密时容器也只是普通的数据，不识别
+        self.container = None
+        self.plain_range = None
+        if (opt_type in ('decrypt', 'verify') and self.mmap_ is not None
+                and Container.is_container(self.mmap_)):
+            self.container = Container(self.mmap_)
+            self.record_base, self.__record_end = 0, self.container.count
+            if plain_range is not None:
+                start, length = plain_range
+                self.plain_range = (start, start + length)
+                self.record_base, self.__record_end = self.container.locate(start, length)
+
+    def startswith(self, prefix):
+        if self.mmap_ is not None:
+            return self.mmap_[:len(prefix)] == prefix
+        # 管道只能偷看一下缓冲区中的数据，不能读出来
+        if hasattr(self.__file, 'peek'):
+            return self.__file.peek(len(prefix))[:len(prefix)] == prefix
+        return False
 
     def __file_content_to_buffer(self, type_='block', size=32):
         # 根据type_的类型，size也将会表现为不同的类型
         # 对于block，size表现为“兆字节”；对于row，size表现为“千行”
         if type_ == 'block':
             real_size = size * 1024 * 1024
+            if self.buffer_blocks:
+                real_size = self.buffer_blocks * self.bs
             file_content = self.__file.read(real_size)
 
             if not file_content:
@@ -57,15 +136,16 @@ class SourceFile(object):
             self.buffer_ = io.BytesIO(file_content)
 
         else: # type == 'row'
-            self.buffer_ = Queue()
+            # 只是进程内的缓冲，用deque即可，不必经过多进程队列
+            self.buffer_ = deque()
             try:
-                for i in range(size * 1000):
-                    self.buffer_.put(next(self.__file))
+                for i in range(self.buffer_blocks or size * 1000):
+                    self.buffer_.append(next(self.__file))
             except StopIteration:
                 self.__file.close()
 
     def __read_from_buffer(self, type_='block'):
-        if not self.buffer_:
+        if self.buffer_ is None and type_ != 'frame':
             self.__file_content_to_buffer(type_)
 
         if type_ == 'block':
@@ -80,10 +160,20 @@ class SourceFile(object):
             # 若文件尚未关闭，则表示还有数据待读
             # 置空buffer递归自身一次即可返回数据
             return self.__read_from_buffer(type_)
+        elif type_ == 'frame':
+            # 二进制分帧，直接从文件中流式地读出一帧
+            length = read_varint(self.__file)
+            if length is None:
+                self.__file.close()
+                return None
+            data = self.__file.read(length)
+            if len(data) < length:
+                raise ValueError('frame %d is truncated' % self.serial)
+            return data
         else: # type == 'row'
             try:
-                return self.buffer_.get_nowait()
-            except Empty:
+                return self.buffer_.popleft()
+            except IndexError:
                 self.buffer_ = None
 
                 if self.__file.closed:
@@ -91,15 +181,196 @@ class SourceFile(object):
                 # 同上，置空buffer并递归自身一次
                 return self.__read_from_buffer(type_)
 
+    def __peek(self, type_):
+        if self.__peeked is None and not self.eof:
+            self.__peeked = self.__read_from_buffer(type_)
+            if not self.__peeked:
+                self.eof = True
+        return self.__peeked
+
+    def __next_extent(self, size, max_bytes=None):
+        offset = self.serial * self.bs
+        remain = self.size - offset
+        if remain <= 0:
+            self.eof = True
+            return None
+
+        count = min(size, -(-remain // self.bs))
+        if max_bytes:
+            count = max(1, min(count, max_bytes // self.bs))
+
+        length = min(count * self.bs, remain)
+        res = {
+                'offset': offset,
+                'length': length,
+                'serial': self.serial,
+                'count': count,
+                'end': offset + length,
+                # batch中的最后一块是否也是文件的最后一块
+                'last': offset + length == self.size,
+                }
+        self.serial += count
+        return res
+
+    def __next_span(self, max_bytes=None):
+        # 取一段约max_bytes字节的区间，结尾延伸到下一个换行符为止，
+        # 使区间总是由若干完整的行组成
+        offset = self.__span_offset
+        if offset >= self.size:
+            self.eof = True
+            return None
+
+        end = min(offset + (max_bytes or 4 * 1024 * 1024), self.size)
+        if end < self.size:
+            newline = self.mmap_.find(b'\n', end - 1)
+            end = self.size if newline == -1 else newline + 1
+        self.__span_offset = end
+
+        res = {
+                'offset': offset,
+                'length': end - offset,
+                'serial': self.serial,
+                'count': 1,
+                'span': True,
+                'end': end,
+                }
+        self.serial += 1
+        return res
+
+    def __next_records(self, size, max_bytes=None):
+        # serial从0开始计数，对应的是容器中的第record_base + serial个数据块
+        offsets = self.container.offsets
+        first = self.record_base + self.serial
+        if first >= self.__record_end:
+            self.eof = True
+            return None
+
+        last = min(first + size, self.__record_end)
+        if max_bytes:
+            limit = bisect_right(offsets, offsets[first] + max_bytes, first) - 1
+            last = max(first + 1, min(last, limit))
+
+        res = {
+                'offset': offsets[first],
+                'length': offsets[last] - offsets[first],
+                'serial': self.serial,
+                'count': last - first,
+                'records': True,
+                'trim': None,
+                'end': offsets[last],
+                }
+        if self.plain_range is not None:
+            # 首尾两块中不在范围内的明文，由worker解密后切掉
+            plain_offset = self.container.plains[first]
+            res['trim'] = (max(0, self.plain_range[0] - plain_offset),
+                           self.plain_range[1] - plain_offset)
+
+        self.serial += last - first
+        return res
+
+    def __next_frames(self, size, max_bytes=None):
+        # 沿着varint长度前缀向后扫描，取出最多size个完整的帧
+        offset = self.__span_offset
+        if offset >= self.size:
+            self.eof = True
+            return None
+
+        end = offset
+        count = 0
+        while count < size and end < self.size:
+            length, payload = unpack_varint(self.mmap_, end)
+            if payload + length > self.size:
+                raise ValueError('frame %d is truncated' % (self.serial + count))
+            if count and max_bytes and payload + length - offset > max_bytes:
+                break
+            end = payload + length
+            count += 1
+        self.__span_offset = end
+
+        res = {
+                'offset': offset,
+                'length': end - offset,
+                'serial': self.serial,
+                'count': count,
+                'frames': True,
+                'end': end,
+                }
+        self.serial += count
+        return res
+
+    def seek(self, serial, offset):
+        # 续传时从第serial块、输入中的offset处继续读取
+        # 按块读取时offset为serial * bs，按行和分帧时为区间的结尾，容器格式只用到serial
+        self.serial = serial
+        self.__span_offset = offset
+        if self.mmap_ is None:
+            self.__file.seek(offset)
+
+    def get_span(self, extent):
+        return memoryview(self.mmap_)[extent['offset']: extent['offset'] + extent['length']]
+
+    def get_blocks(self, extent):
+        # 把(offset, length)描述的一段数据切成若干个memoryview，不发生拷贝
+        view = memoryview(self.mmap_)
+        end = extent['offset'] + extent['length']
+        return [view[offset: min(offset + self.bs, end)]
+                for offset in range(extent['offset'], end, self.bs)]
+
+    def _next_batch(self, type_, size, max_bytes=None):
+        # 取出最多size个连续的数据块，总字节数不超过max_bytes
+        # 但无论如何至少包含一块，以免单个数据块比max_bytes还大时卡住
+        if self.container is not None:
+            return self.__next_records(size, max_bytes)
+        if type_ == 'block' and self.mmap_ is not None:
+            return self.__next_extent(size, max_bytes)
+        # 按行解密时，以按行对齐的大区间为单位分发，serial为区间的序号
+        if type_ == 'row' and self.mmap_ is not None:
+            return self.__next_span(max_bytes)
+        if type_ == 'frame' and self.mmap_ is not None:
+            return self.__next_frames(size, max_bytes)
+
+        blocks = []
+        total = 0
+        while len(blocks) < size:
+            data = self.__peek(type_)
+            if not data:
+                break
+            if blocks and max_bytes and total + len(data) > max_bytes:
+                break
+
+            blocks.append(data)
+            total += len(data)
+            self.__peeked = None
+
+        if not blocks and type_ == 'block' and self.serial == 0 and self.empty_block:
+            blocks.append(b'')
+        if not blocks:
+            return None
+
+        res = {
+                'blocks': blocks,
+                'serial': self.serial,
+                'count': len(blocks),
+                'last': not self.__peek(type_),
+                # 从管道按行读入的数据，armor时每一行是一整段帧的base64
+                'rows': type_ == 'row',
+                }
+        self.serial += len(blocks)
+        return res
+
     def _next(self, type_):
-        data = self.__read_from_buffer(type_)
-        if data:
-            res = {
-                    'block': data,
-                    'serial': self.serial,
+        batch = self._next_batch(type_, 1)
+        if batch:
+            if batch.get('span') or batch.get('records') or batch.get('frames'):
+                blocks = [self.get_span(batch)]
+            elif 'offset' in batch:
+                blocks = self.get_blocks(batch)
+            else:
+                blocks = batch['blocks']
+            return {
+                    'block': blocks[0],
+                    'serial': batch['serial'],
                     }
-            self.serial += 1
-            return res
         return None
 
     def _next_block(self):
@@ -108,71 +379,981 @@ class SourceFile(object):
     def _next_row(self):
         return self._next('row')
 
+    def close(self):
+        if self.mmap_ is not None:
+            self.mmap_.close()
+        self.__file.close()
+
+
+class PreadSource(object):
+    ''' 批量模式下worker按(offset, length)直接从文件中读取数据
+
+    批量模式的文件在worker启动之后才打开，worker无法继承它们的映射
+    '''
+
+    record_base = 0
+
+    def __init__(self, path, bs):
+        self.path = path
+        self.bs = bs
+
+    def get_span(self, extent):
+        fd = os.open(self.path, os.O_RDONLY)
+        try:
+            data = os.pread(fd, extent['length'], extent['offset'])
+        finally:
+            os.close(fd)
+        if len(data) < extent['length']:
+            raise ValueError('%s is truncated while being read' % self.path)
+        return data
+
+    def get_blocks(self, extent):
+        view = memoryview(self.get_span(extent))
+        return [view[offset: offset + self.bs] for offset in range(0, len(view), self.bs)]
+
+
+def check_options(framing, armor, container, compression):
+    # 数据块的分帧方式，text为每块单独base64编码后加换行，
+    # binary为varint长度前缀加原始密文。
+    # armor表示在binary的基础上，对整段输出再做一次base64，使其可以作为文本保存
+    if framing not in ('text', 'binary'):
+        raise ValueError('unknown framing: %s' % framing)
+    if armor and (framing != 'binary' or container):
+        raise ValueError('armor only applies to binary framing without container')
+
+    # 加密前在worker中逐块压缩，解密后解压。
+    # 除容器格式外，解密时须指定和加密时同样的compression
+    if compression is not None and compression not in Compressor.ALGORITHMS:
+        raise ValueError('unknown compression: %s' % compression)
+    if compression == 'zstd' and zstandard is None:
+        raise ValueError('zstd compression needs the zstandard package')
+
+
+def batch_bytes(data):
+    # master读出的一个batch中输入数据的字节数
+    if 'length' in data:
+        return data['length']
+    return sum(len(block) for block in data['blocks'])
+
+
+def batch_type(opt_type, framing, armor):
+    # master分发数据的方式
+    if opt_type == 'encrypt':
+        return 'block'
+    if framing == 'binary' and not armor:
+        return 'frame'
+    return 'row'  # 文本格式的解密
+
 
 class Master(object):
+    # engine为auto时，输入不超过INLINE_MAX_SIZE时在master中直接处理，
+    # 不超过THREADS_MAX_SIZE时使用线程，更大的输入才值得fork出worker进程
+    INLINE_MAX_SIZE = 1024 * 1024
+    THREADS_MAX_SIZE = 32 * 1024 * 1024
+
     def __init__(self,
                  source_file_path,
                  crypto_type,
                  opt_type='encrypt',
                  output_file_path=None,
                  bs=None,
+                 container=False,
+                 plain_range=None,
+                 framing='text',
+                 armor=False,
+                 compression=None,
+                 checkpoint=False,
+                 resume=False,
+                 checkpoint_interval=None,
+                 merkle=False,
+                 expected_leaves=None,
                  **kwargs):
-        crypto_type_map = {
-                'base64': CryptoBase64,
-                }
-
         # 通信队列，worker向master请求数据用
-        self.request_queue = Queue()
-        # master向worker返回数据用，在start函数中生成
+        # 与master向worker返回数据用的队列一样，根据执行方式在start函数中生成
+        self.request_queue = None
         self.resp_queue_map = None
         # block_size，块大小
         self.bs = bs
 
         # 源文件
-        self.source_file = SourceFile(source_file_path, bs=bs)
+        self.source_file = SourceFile(source_file_path, bs=bs, plain_range=plain_range, opt_type=opt_type)
         # 操作类型，指代encrypt和decrypt
         self.opt_type = opt_type
 
+        # 加密时是否以容器格式输出，解密时则根据源文件自动识别
+        self.container = container
+        source_container = self.source_file.container
+        if source_container is not None:
+            # verify只校验hash，与加密类型无关
+            if source_container.params['crypto_type'] != crypto_type and opt_type != 'verify':
+                raise ValueError(
+                    'container is encrypted with %s, not %s'
+                    % (source_container.params['crypto_type'], crypto_type)
+                )
+            # 容器的header中记录了是否压缩
+            compression = source_container.params.get('compression')
+        elif opt_type == 'decrypt' and self.source_file.startswith(Container.MAGIC):
+            raise ValueError('container format needs a seekable source file, not a pipe')
+        elif plain_range is not None:
+            raise ValueError('plain_range needs a container format source file')
+
+        check_options(framing, armor, container, compression)
+        self.framing = framing
+        self.armor = armor
+        self.compression = compression
+
+        self.crypto_type = crypto_type
         crypto_class = crypto_type_map.get(crypto_type)
-        self.crypto_type_obj = crypto_class(**kwargs)
-        self.output_file_path = output_file_path or source_file_path + '.scoutput'
+        self.crypto_type_obj = crypto_class(framing=framing, compression=compression, **kwargs)
+        if opt_type == 'encrypt' and self.crypto_type_obj.BLOCK_ORDER:
+            self.source_file.empty_block = True
+        if source_file_path == '-':
+            self.output_file_path = output_file_path or '-'
+        else:
+            self.output_file_path = output_file_path or source_file_path + '.scoutput'
+
+        # merkle时worker顺带计算每个加密后数据块的hash，写完后在输出文件旁保存manifest。
+        # opt_type为verify时只计算源文件中每个数据块的hash，
+        # 由写入线程逐个与expected_leaves文件中的叶子比较
+        if merkle and (opt_type != 'encrypt' or armor or self.output_file_path == '-'):
+            raise ValueError('merkle only applies to encryption into a file without armor')
+        if merkle and (checkpoint or resume):
+            raise ValueError('merkle cannot be combined with checkpoint')
+        self.merkle = merkle
+        self.expected_leaves = expected_leaves
+        self.merkle_tree = None
+
+        # checkpoint时写入线程定期把写入进度记在输出文件旁的日志中，
+        # resume时从日志中记录的进度继续，参数与上一次不同时拒绝继续
+        self.journal = None
+        self.resume_state = None
+        if checkpoint or resume:
+            if not os.path.isfile(source_file_path) or self.output_file_path == '-':
+                raise ValueError('checkpoint needs a regular source file and output file')
+            if container and opt_type == 'encrypt':
+                raise ValueError('checkpoint is not supported for container output')
+            self.journal = Journal(self.output_file_path + '.journal',
+                                   self.__job_params(source_file_path, plain_range),
+                                   checkpoint_interval,
+                                   self.crypto_type_obj.salt if opt_type == 'encrypt' else None)
+        if resume:
+            state = self.journal.load()
+            if state.get('salt') is not None:
+                salt = bytes.fromhex(state['salt'])
+                self.crypto_type_obj = self.crypto_type_obj.with_salt(salt)
+                self.journal.salt = salt
+            try:
+                output_size = os.path.getsize(self.output_file_path)
+            except OSError:
+                output_size = -1
+            if output_size < state['output_offset']:
+                raise ValueError('output file is shorter than the journal records')
+            self.source_file.seek(state['serial'], state['input_offset'])
+            self.resume_state = state
+
+    def __job_params(self, source_file_path, plain_range):
+        # 决定输出内容的参数，续传时必须与日志中记录的一致
+        return {
+                'source': os.path.abspath(source_file_path),
+                'source_size': self.source_file.size,
+                'source_mtime': os.stat(source_file_path).st_mtime_ns,
+                'opt_type': self.opt_type,
+                'crypto_type': self.crypto_type,
+                'key': self.crypto_type_obj.key_fingerprint(),
+                'bs': self.source_file.bs,
+                'framing': self.framing,
+                'armor': self.armor,
+                'compression': self.compression,
+                'plain_range': list(plain_range) if plain_range else None,
+                }
 
-    def __source_file_mgr_start(self):
-        if self.opt_type == 'encrypt':
-            func_for_get_data = self.source_file._next_block
-        else:  # self.opt_type == 'decrypt'
-            func_for_get_data = self.source_file._next_row
+    def __source_file_mgr_start(self, transport, limiter, stats, output_handler):
+        type_ = batch_type(self.opt_type, self.framing, self.armor)
 
         while True:
-            data = func_for_get_data()
+            # worker在请求中附带它希望一次拿到的数据块数量
+            started = time.perf_counter()
+            process_serial, batch_size = self.request_queue.get()
+            if isinstance(batch_size, str):
+                # worker出错退出前发来的是出错原因，停止分发，其余的worker随之退出
+                stop_workers(self.resp_queue_map)
+                return 'worker %d failed: %s' % (process_serial, batch_size)
+            if output_handler.failed is not None:
+                # 写入线程已经出错，由join_writer抛出它
+                stop_workers(self.resp_queue_map)
+                return None
+            requested = time.perf_counter()
+            if limiter is not None:
+                batch_size = min(batch_size, limiter.max_blocks)
+                limiter.acquire(batch_size)
+            acquired = time.perf_counter()
+
+            try:
+                data = self.source_file._next_batch(type_,
+                                                    batch_size,
+                                                    transport.max_batch_bytes)
+            except (ValueError, OSError) as e:
+                # 输入本身有问题(如最后一帧不完整)，写入线程不再写入，由join_writer抛出它
+                output_handler.failed = e
+                stop_workers(self.resp_queue_map)
+                return None
+            if limiter is not None:
+                limiter.release(batch_size - (data['count'] if data else 0))
+
             if data:
-                process_serial = self.request_queue.get()
+                stats.add_read(data['count'],
+                               batch_bytes(data),
+                               time.perf_counter() - acquired,
+                               requested - started,
+                               acquired - requested)
+                data = transport.send_input(data)
                 self.resp_queue_map[process_serial].put(data)
             else:
-                for resp_queue in self.resp_queue_map.values():
-                    resp_queue.put(None)
-                break
+                # 写入线程据此检查分发出去的数据块是否全部写入了
+                output_handler.end_serial = self.source_file.serial
+                stop_workers(self.resp_queue_map)
+                return None
+
+    def __inline_start(self, worker, output_handler, transport, stats):
+        # 在master中依次读取、处理、写入，数据本来就是有序的，用不到队列和乱序窗口
+        type_ = batch_type(self.opt_type, self.framing, self.armor)
+        output_handler.open()
+        try:
+            while True:
+                started = time.perf_counter()
+                data = self.source_file._next_batch(type_,
+                                                    worker.max_batch_size,
+                                                    transport.max_batch_bytes)
+                if not data:
+                    break
+                read = time.perf_counter()
+                stats.add_read(data['count'], batch_bytes(data), read - started)
+
+                data = transport.send_output(data, worker.process(data))
+                processed = time.perf_counter()
+                stats.add_worker(0, data['count'], data['length'], processed - read)
+                output_handler.write_run([data])
+        except Exception:
+            output_handler.abort()
+            raise
+        output_handler.close()
+
+    def __choose_engine(self, engine, workers, output_mode):
+        if engine != 'auto':
+            return engine
+        # 大小未知的输入(如管道)按大文件处理
+        size = self.source_file.size if self.source_file.regular else None
+        small = workers <= 1 or (size is not None and size <= self.INLINE_MAX_SIZE)
+        if small and output_mode != 'pwrite':
+            return 'inline'
+        if size is not None and size <= self.THREADS_MAX_SIZE:
+            return 'threads'
+        return 'processes'
+
+    def __block_order(self):
+        # 写入线程检查数据块顺序的方式，只解密明文中的一段时不要求以最后一块结束
+        if self.opt_type != 'decrypt' or not self.crypto_type_obj.BLOCK_ORDER:
+            return None
+        if self.source_file.plain_range is not None:
+            return 'continuous'
+        return 'complete'
+
+    def __pwrite_layout(self):
+        # 返回(每块输出的大小, 输出文件的总大小, 数据块数量)，无法预先确定时返回None
+        if self.opt_type != 'encrypt' or self.container or self.armor:
+            return None
+        # pwrite乱序写入，没有可以记入日志的连续进度，也不能按顺序收集hash
+        if self.journal is not None or self.merkle:
+            return None
+        if self.output_file_path == '-':
+            return None
+        if self.source_file.mmap_ is None:
+            return None
+
+        bs = self.source_file.bs
+        unit_size = self.crypto_type_obj.output_size(bs)
+        if unit_size is None:
+            return None
+
+        full, remain = divmod(self.source_file.size, bs)
+        output_size = full * unit_size
+        block_count = full
+        if remain:
+            output_size += self.crypto_type_obj.output_size(remain)
+            block_count += 1
+        return unit_size, output_size, block_count
+
+    def start(self,
+              workers=1,
+              max_pending_bytes=None,
+              transport='queue',
+              slots=None,
+              slot_size=None,
+              batch_time=None,
+              output_mode='auto',
+              max_inflight=None,
+              engine='auto',
+              progress=None):
+        transport_map = {
+                'queue': QueueTransport,
+                'shm': ShmTransport,
+                }
+
+        # 执行方式，processes为每个worker一个进程，threads为每个worker一个线程，
+        # inline为在master中单线程处理，auto根据输入大小和worker数量选择
+        engine = self.__choose_engine(engine, workers, output_mode)
+        if engine != 'inline' and engine not in engine_map:
+            raise ValueError('unknown engine: %s' % engine)
+
+        # 输出方式，ordered由写入线程按serial顺序写入，
+        # pwrite由worker直接写到预先算好的位置，只适用于输出大小固定的加密，
+        # auto则在可以使用pwrite时使用pwrite
+        layout = self.__pwrite_layout()
+        if output_mode == 'pwrite' and engine == 'inline':
+            raise ValueError('inline engine writes in order, pwrite is not available')
+        if output_mode == 'pwrite' and self.journal is not None:
+            raise ValueError('checkpoint needs ordered output, pwrite is not available')
+        if output_mode == 'pwrite' and layout is None:
+            raise ValueError('output size of this job is not predictable, pwrite is not available')
+        use_pwrite = output_mode in ('auto', 'pwrite') and layout is not None and engine != 'inline'
+
+        # 数据块的传输方式，queue直接经由队列传递数据块
+        # shm则只传递共享内存中的槽位编号，slots默认为每个worker 4个槽位。
+        # pwrite时worker直接从源文件的映射读取、直接写入输出文件，用不到shm，
+        # 不使用进程时数据块本来就在同一个进程中，也用不到
+        transport_class = transport_map.get(transport)
+        if transport_class is ShmTransport and not use_pwrite and engine == 'processes':
+            transport_obj = ShmTransport(slots or workers * 4, slot_size)
+        else:
+            transport_obj = QueueTransport()
+
+        # inline只有master自己，所用的队列和线程的一样，但实际上用不到
+        if engine == 'inline':
+            workers = 1
+        engine_obj = engine_map.get(engine, ThreadEngine)()
 
-    def start(self, workers=1):
         # 根据workers的数量生成同数量的通信队列
-        self.resp_queue_map = {serial: Queue() for serial in range(workers)}
-        output_handler = OutputHandler(self.output_file_path, workers)
+        self.request_queue = engine_obj.queue()
+        self.resp_queue_map = {serial: engine_obj.queue() for serial in range(workers)}
+        container_params = None
+        if self.container and self.opt_type == 'encrypt':
+            container_params = {
+                    'crypto_type': self.crypto_type,
+                    'bs': self.source_file.bs,
+                    'compression': self.compression,
+                    }
+
+        merkle = None
+        if self.merkle:
+            merkle = {
+                    'path': self.output_file_path + '.merkle',
+                    'params': {
+                            'framing': self.framing,
+                            'container': container_params is not None,
+                            },
+                    }
+        elif self.opt_type == 'verify':
+            merkle = {'path': None, 'params': None, 'expected': self.expected_leaves}
+
+        # 各阶段的计数，progress不为None时每隔progress秒在标准错误输出一行进度
+        self.stats = Stats(workers,
+                           engine,
+                           'shm' if isinstance(transport_obj, ShmTransport) else 'queue',
+                           'pwrite' if use_pwrite else 'ordered')
+        if progress:
+            self.stats.start_progress(progress, self.source_file.size if self.source_file.regular else None)
+
+        # 最多同时有max_inflight个数据块在处理中(已读出但尚未写入)。
+        # 从管道等无法映射的源读取时默认开启，每个worker 16块，
+        # 源的读缓冲也随之缩小到同样的块数，内存占用因此只和bs * workers有关
+        limiter = None
+        if engine != 'inline' and not use_pwrite and (max_inflight or self.source_file.mmap_ is None):
+            limiter = InflightLimiter(max_inflight or workers * 16)
+            self.source_file.buffer_blocks = limiter.max_blocks
+
+        if use_pwrite:
+            output_handler = PwriteOutputHandler(self.output_file_path, workers, *layout,
+                                                 engine=engine_obj)
+        else:
+            output_handler = OutputHandler(self.output_file_path,
+                                           workers,
+                                           transport_obj,
+                                           max_pending_bytes=max_pending_bytes,
+                                           container=container_params,
+                                           armor=self.armor and self.opt_type == 'encrypt',
+                                           limiter=limiter,
+                                           journal=self.journal,
+                                           resume_state=self.resume_state,
+                                           engine=engine_obj,
+                                           stats=self.stats,
+                                           merkle=merkle,
+                                           order=self.__block_order())
+
+        # 输出到标准输出时，避免fork出的worker在退出时再写一遍缓冲区中的内容
+        sys.stdout.flush()
 
         # 启动各种worker
+        workers_list = [Worker(self.request_queue,
+                               self.resp_queue_map[serial],
+                               self.crypto_type_obj,
+                               output_handler,
+                               transport_obj,
+                               self.source_file,
+                               opt_type=self.opt_type,
+                               serial=serial,
+                               batch_time=batch_time,
+                               container=container_params is not None,
+                               engine=engine_obj,
+                               stats=self.stats,
+                               hash_blocks=self.merkle)
+                        for serial in range(workers)]
+        try:
+            if engine == 'inline':
+                self.__inline_start(workers_list[0], output_handler, transport_obj, self.stats)
+            else:
+                for worker in workers_list:
+                    worker.start()
+                output_handler.start()
+
+                # master开始监听request_queue
+                error = self.__source_file_mgr_start(transport_obj, limiter, self.stats, output_handler)
+                join_writer(output_handler, error, workers_list, self.request_queue)
+        finally:
+            self.stats.stop_progress()
+            # 出错时也要删除共享内存
+            transport_obj.close()
+        self.merkle_tree = getattr(output_handler, 'merkle_tree', None)
+        return self.stats.summary()
+
+
+def walk_tree(source_dir, output_dir):
+    ''' 遍历source_dir下的所有普通文件，生成(源文件, 输出文件)
+
+    输出文件在output_dir下保持与源文件相同的目录结构
+    '''
+    output_real = os.path.realpath(output_dir)
+    for root, dirs, files in os.walk(source_dir):
+        # 输出目录在源目录中时，不能把已经写出的输出也当作源文件
+        dirs[:] = sorted(name for name in dirs
+                         if os.path.realpath(os.path.join(root, name)) != output_real)
+        for name in sorted(files):
+            source_path = os.path.join(root, name)
+            if os.path.isfile(source_path):
+                yield source_path, os.path.join(output_dir, os.path.relpath(source_path, source_dir))
+
+
+class BatchMaster(object):
+    ''' 用同一组worker处理多个文件
+
+    master依次打开各个文件，把它们的数据块连续地分发出去，
+    一个文件剩下的数据不足一个batch时，会和后面的文件装进同一个batch。
+    worker直接从文件中读取数据，结果由写入线程按文件分别排序，写入各自的输出文件。
+    加密时每个文件随机生成各自的salt，派生出各自的子密钥，与逐个文件运行Master时一样。
+    出错的文件不影响其他文件，全部处理完后一并报告
+    '''
+
+    def __init__(self,
+                 crypto_type,
+                 opt_type='encrypt',
+                 bs=None,
+                 container=False,
+                 framing='text',
+                 armor=False,
+                 compression=None,
+                 **kwargs):
+        check_options(framing, armor, container, compression)
+        self.crypto_type = crypto_type
+        self.opt_type = opt_type
+        self.bs = bs
+        self.container = container and opt_type == 'encrypt'
+        self.framing = framing
+        self.armor = armor
+        self.compression = compression
+
+        crypto_class = crypto_type_map.get(crypto_type)
+        self.crypto_type_obj = crypto_class(framing=framing, compression=compression, **kwargs)
+
+        self.request_queue = None
+        self.resp_queue_map = None
+        self.file_count = 0
+        # (源文件, 出错原因)
+        self.failures = []
+
+    def __check_source(self, source_file):
+        container = source_file.container
+        if container is None:
+            return
+        if self.opt_type == 'encrypt':
+            return
+        if container.params['crypto_type'] != self.crypto_type:
+            raise ValueError('container is encrypted with %s' % container.params['crypto_type'])
+        if container.params.get('compression') != self.compression:
+            raise ValueError('container is compressed with %s' % container.params.get('compression'))
+
+    def __next_file(self, jobs, output_handler):
+        # 打开下一个文件，所有文件都已分发时返回None
+        for source_path, output_path in jobs:
+            try:
+                source_file = SourceFile(source_path, bs=self.bs, opt_type=self.opt_type)
+            except (OSError, ValueError) as e:
+                output_handler.fail(source_path, e)
+                continue
+            if self.opt_type == 'encrypt' and self.crypto_type_obj.BLOCK_ORDER:
+                source_file.empty_block = True
+
+            container_params = None
+            if self.container:
+                container_params = {
+                        'crypto_type': self.crypto_type,
+                        'bs': source_file.bs,
+                        'compression': self.compression,
+                        }
+            file_id = self.file_count
+            try:
+                self.__check_source(source_file)
+                output_handler.add_file(file_id, source_path, output_path, container_params)
+            except (OSError, ValueError) as e:
+                source_file.close()
+                output_handler.fail(source_path, e)
+                continue
+
+            self.file_count += 1
+            salt = None
+            if self.opt_type == 'encrypt':
+                salt = self.crypto_type_obj.new_salt()
+            return {
+                    'id': file_id,
+                    'path': source_path,
+                    'source': source_file,
+                    'salt': salt,
+                    }
+        return None
+
+    def __source_file_mgr_start(self, jobs, transport, limiter, output_handler):
+        type_ = batch_type(self.opt_type, self.framing, self.armor)
+        max_bytes = transport.max_batch_bytes
+        current = self.__next_file(jobs, output_handler)
+
+        while True:
+            started = time.perf_counter()
+            process_serial, batch_size = self.request_queue.get()
+            if isinstance(batch_size, str):
+                stop_workers(self.resp_queue_map)
+                return 'worker %d failed: %s' % (process_serial, batch_size)
+            requested = time.perf_counter()
+            batch_size = min(batch_size, limiter.max_blocks)
+            limiter.acquire(batch_size)
+            acquired = time.perf_counter()
+
+            # 从当前文件开始取数据，当前文件取完了就接着取下一个文件
+            items = []
+            count = 0
+            total = 0
+            while current is not None and count < batch_size and total < max_bytes:
+                source_file = current['source']
+                try:
+                    data = source_file._next_batch(type_, batch_size - count, max_bytes - total)
+                except (ValueError, OSError) as e:
+                    # 这个文件本身有问题(如最后一帧不完整)，丢弃它，接着取下一个文件
+                    source_file.close()
+                    output_handler.fail_file(current['id'], e)
+                    current = self.__next_file(jobs, output_handler)
+                    continue
+                if not data:
+                    source_file.close()
+                    output_handler.finish_file(current['id'], source_file.serial)
+                    current = self.__next_file(jobs, output_handler)
+                    continue
+
+                data['file'] = current['id']
+                data['path'] = current['path']
+                data['bs'] = source_file.bs
+                data['salt'] = current['salt']
+                items.append(data)
+                count += data['count']
+                total += batch_bytes(data)
+            limiter.release(batch_size - count)
+            if items:
+                self.stats.add_read(count,
+                                    total,
+                                    time.perf_counter() - acquired,
+                                    requested - started,
+                                    acquired - requested)
+
+            if items:
+                self.resp_queue_map[process_serial].put({'items': items, 'count': count})
+            else:
+                stop_workers(self.resp_queue_map)
+                return None
+
+    def start(self, jobs, workers=1, engine='auto', batch_time=None, max_inflight=None, progress=None):
+        # jobs为(源文件, 输出文件)的序列，可以是walk_tree这样的生成器
+        if engine == 'auto':
+            engine = 'processes' if workers > 1 else 'threads'
+        if engine not in engine_map:
+            raise ValueError('batch mode runs on threads or processes, not %s' % engine)
+        engine_obj = engine_map[engine]()
+
+        # worker直接从文件中读取，队列中只有读不了映射的数据，用不到shm
+        transport_obj = QueueTransport()
+        self.request_queue = engine_obj.queue()
+        self.resp_queue_map = {serial: engine_obj.queue() for serial in range(workers)}
+        self.stats = Stats(workers, engine, 'queue', 'ordered')
+        if progress:
+            self.stats.start_progress(progress)
+
+        # 同时在处理中的数据块数量始终有上限，打开着的输出文件也因此有上限
+        limiter = InflightLimiter(max_inflight or workers * 64)
+        order = None
+        if self.opt_type == 'decrypt' and self.crypto_type_obj.BLOCK_ORDER:
+            order = 'complete'
+        output_handler = BatchOutputHandler(workers,
+                                            transport_obj,
+                                            limiter,
+                                            armor=self.armor and self.opt_type == 'encrypt',
+                                            engine=engine_obj,
+                                            stats=self.stats,
+                                            order=order)
+
+        sys.stdout.flush()
+        workers_list = []
         for serial in range(workers):
-            worker = Worker(self.request_queue,
-                            self.resp_queue_map[serial],
-                            self.crypto_type_obj,
-                            output_handler,
-                            opt_type=self.opt_type,
-                            serial=serial)
+            worker = BatchWorker(self.request_queue,
+                                 self.resp_queue_map[serial],
+                                 self.crypto_type_obj,
+                                 output_handler,
+                                 transport_obj,
+                                 None,
+                                 opt_type=self.opt_type,
+                                 serial=serial,
+                                 batch_time=batch_time,
+                                 container=self.container,
+                                 engine=engine_obj,
+                                 stats=self.stats)
             worker.start()
+            workers_list.append(worker)
         output_handler.start()
 
-        # master开始监听request_queue
-        self.__source_file_mgr_start()
+        try:
+            error = self.__source_file_mgr_start(iter(jobs), transport_obj, limiter, output_handler)
+            join_writer(output_handler, error, workers_list, self.request_queue)
+        finally:
+            self.stats.stop_progress()
 
+        self.failures = output_handler.failures
+        if self.failures:
+            raise RuntimeError(
+                '%d files failed, first is %s: %s' % ((len(self.failures), ) + self.failures[0])
+            )
+        return self.stats.summary()
+
+
+def stop_workers(resp_queue_map):
+    # 通知所有worker不再有数据，处理完手上的batch后退出
+    for resp_queue in resp_queue_map.values():
+        resp_queue.put(None)
+
+
+def join_writer(output_handler, error=None, workers=(), request_queue=None):
+    # error为worker出错的原因。此时写入线程多半会报告缺失的数据块，
+    # 出错的原因更有用，抛出它
+    writer_error = None
+    try:
         output_handler.join()
+    except Exception as e:
+        writer_error = e
+
+    if error is None and output_handler.workers_stopped:
+        # 最后几个batch出错时，master已经分发完毕，不再读取请求，出错原因还留在队列中。
+        # worker都已结束，等它们退出后，它们发出的请求就都到齐了
+        for worker in workers:
+            worker.join()
+        error = worker_error(request_queue)
+
+    if error is not None:
+        raise RuntimeError(error)
+    if writer_error is not None:
+        raise writer_error
+
+
+def worker_error(request_queue):
+    # 取出队列中剩下的请求，返回其中第一个出错原因
+    error = None
+    while True:
+        try:
+            process_serial, batch_size = request_queue.get_nowait()
+        except Empty:
+            return error
+        if isinstance(batch_size, str) and error is None:
+            error = 'worker %d failed: %s' % (process_serial, batch_size)
+
+
+class Stats(object):
+    ''' 流水线各阶段的计数，用于找出慢在哪里
+
+    worker的计数放在共享内存中，每个worker只写自己的那一行；
+    master读取数据和写入线程的计数都在master进程中，直接用普通的属性
+    '''
+
+    WORKER_FIELDS = ('blocks', 'bytes', 'busy', 'wait_request', 'wait_save')
+
+    def __init__(self, workers, engine=None, transport=None, output_mode=None):
+        self.workers = workers
+        # 实际使用的执行方式、传输方式和输出方式，可能与请求的不同
+        self.engine = engine
+        self.transport = transport
+        self.output_mode = output_mode
+        self.worker_counters = Array('d', workers * len(self.WORKER_FIELDS), lock=False)
+        self.started = time.perf_counter()
+        self.finished = None
+
+        # master读取数据，以及等待worker请求、等待在处理中的数据块减少的时间
+        self.read_blocks = 0
+        self.read_bytes = 0
+        self.read_time = 0.0
+        self.wait_request = 0.0
+        self.wait_inflight = 0.0
+
+        # 写入线程每次写入的大小，以及乱序窗口的深度
+        self.flushes = 0
+        self.flush_bytes = 0
+        self.max_flush = 0
+        self.write_time = 0.0
+        self.window = 0
+        self.window_samples = 0
+        self.window_total = 0
+        self.max_window = 0
+
+        self.__progress = None
+        self.__total_bytes = None
+
+    def add_worker(self, serial, blocks, size, busy, wait_request=0.0, wait_save=0.0):
+        counters = self.worker_counters
+        base = serial * len(self.WORKER_FIELDS)
+        for i, value in enumerate((blocks, size, busy, wait_request, wait_save)):
+            counters[base + i] += value
+
+    def add_read(self, blocks, size, elapsed, wait_request=0.0, wait_inflight=0.0):
+        self.read_blocks += blocks
+        self.read_bytes += size
+        self.read_time += elapsed
+        self.wait_request += wait_request
+        self.wait_inflight += wait_inflight
+
+    def add_flush(self, size, elapsed):
+        self.flushes += 1
+        self.flush_bytes += size
+        self.max_flush = max(self.max_flush, size)
+        self.write_time += elapsed
+
+    def add_window(self, depth):
+        self.window = depth
+        self.window_samples += 1
+        self.window_total += depth
+        self.max_window = max(self.max_window, depth)
+
+    def elapsed(self):
+        return (self.finished or time.perf_counter()) - self.started
+
+    def worker(self, serial):
+        base = serial * len(self.WORKER_FIELDS)
+        res = dict(zip(self.WORKER_FIELDS,
+                       self.worker_counters[base: base + len(self.WORKER_FIELDS)]))
+        res['blocks'] = int(res['blocks'])
+        res['bytes'] = int(res['bytes'])
+        elapsed = self.elapsed()
+        res['blocks_per_sec'] = res['blocks'] / elapsed if elapsed else 0.0
+        res['bytes_per_sec'] = res['bytes'] / elapsed if elapsed else 0.0
+        return res
+
+    def summary(self):
+        self.finished = self.finished or time.perf_counter()
+        return {
+                'elapsed': self.elapsed(),
+                'engine': self.engine,
+                'transport': self.transport,
+                'output_mode': self.output_mode,
+                'master': {
+                        'blocks': self.read_blocks,
+                        'bytes': self.read_bytes,
+                        'read_time': self.read_time,
+                        'wait_request': self.wait_request,
+                        'wait_inflight': self.wait_inflight,
+                        },
+                'workers': [self.worker(serial) for serial in range(self.workers)],
+                'writer': {
+                        'flushes': self.flushes,
+                        'bytes': self.flush_bytes,
+                        'avg_flush': self.flush_bytes / self.flushes if self.flushes else 0,
+                        'max_flush': self.max_flush,
+                        'write_time': self.write_time,
+                        'avg_window': self.window_total / self.window_samples if self.window_samples else 0,
+                        'max_window': self.max_window,
+                        },
+                }
+
+    def progress_line(self):
+        elapsed = self.elapsed() or 1e-9
+        workers = [self.worker(serial) for serial in range(self.workers)]
+        line = '[%7.1fs] read %.1fMB' % (elapsed, self.read_bytes / 1024 ** 2)
+        if self.__total_bytes:
+            line += ' (%.0f%%)' % (self.read_bytes * 100 / self.__total_bytes)
+        line += ', %.1fMB/s, output %.1fMB, window %d, workers busy %.0f%% wait %.0f%%' % (
+                self.read_bytes / 1024 ** 2 / elapsed,
+                sum(worker['bytes'] for worker in workers) / 1024 ** 2,
+                self.window,
+                sum(worker['busy'] for worker in workers) * 100 / elapsed / self.workers,
+                sum(worker['wait_request'] for worker in workers) * 100 / elapsed / self.workers,
+                )
+        return line
+
+    def __report(self, interval):
+        while not self.__progress.wait(interval):
+            print(self.progress_line(), file=sys.stderr, flush=True)
+
+    def start_progress(self, interval, total_bytes=None):
+        # 每隔interval秒在标准错误输出一行进度，标准输出可能是数据
+        # total_bytes为输入的总大小，知道时显示百分比
+        self.__total_bytes = total_bytes
+        self.__progress = Event()
+        self.__progress_thread = Thread(target=self.__report, args=(interval, ), daemon=True)
+        self.__progress_thread.start()
+
+    def stop_progress(self):
+        if self.__progress is not None:
+            self.__progress.set()
+            self.__progress_thread.join()
+            self.__progress = None
+            print(self.progress_line(), file=sys.stderr, flush=True)
+
+
+class InflightLimiter(object):
+    ''' 限制已读出但尚未写入的数据块数量
+
+    master在读取数据前acquire，写入线程在写入后release，两者在同一进程中
+    '''
+
+    def __init__(self, max_blocks):
+        self.max_blocks = max_blocks
+        self.blocks = 0
+        self.aborted = False
+        self.cond = LocalCondition()
+
+    def acquire(self, count):
+        with self.cond:
+            while not self.aborted and self.blocks and self.blocks + count > self.max_blocks:
+                self.cond.wait()
+            self.blocks += count
+
+    def abort(self):
+        # 有worker退出后不再限制。出错的worker拿走的数据块永远不会写入，
+        # 否则master会一直等下去，收不到worker发来的出错原因
+        with self.cond:
+            self.aborted = True
+            self.cond.notify_all()
+
+    def release(self, count):
+        if not count:
+            return
+        with self.cond:
+            self.blocks -= count
+            self.cond.notify_all()
+
+
+class Journal(object):
+    ''' 断点续传用的进度日志
+
+    写入线程每隔interval秒，先把输出文件fsync，再记下已连续写入的数据块数量、
+    输出文件的长度和对应的输入偏移。日志先写到临时文件再改名，因此总是完整的。
+    params为任务的参数，续传时须与日志中的一致
+    '''
+
+    def __init__(self, path, params, interval=None, salt=None):
+        self.path = path
+        self.params = params
+        self.interval = interval or 5
+        self.last_commit = time.monotonic()
+        # 加密时这次运行的salt，续传时沿用，同一个文件中的数据块必须使用同一个salt
+        self.salt = salt
+
+    def load(self):
+        try:
+            with open(self.path, 'r') as f:
+                state = json.load(f)
+        except FileNotFoundError:
+            raise ValueError('no journal to resume from: %s' % self.path)
+        except ValueError:
+            raise ValueError('journal is corrupted: %s' % self.path)
+
+        changed = sorted(key for key in set(self.params) | set(state['params'])
+                         if self.params.get(key) != state['params'].get(key))
+        if changed:
+            raise ValueError('job parameters changed since the checkpoint: %s' % ', '.join(changed))
+        return state
+
+    def due(self):
+        return time.monotonic() - self.last_commit >= self.interval
+
+    def commit(self, output_file, serial, input_offset):
+        # 日志中的进度必须已经落盘，否则断电后日志可能比输出文件走得更远
+        output_file.flush()
+        os.fsync(output_file.fileno())
+        state = {
+                'params': self.params,
+                'serial': serial,
+                'output_offset': output_file.tell(),
+                'input_offset': input_offset,
+                'salt': self.salt.hex() if self.salt is not None else None,
+                }
+
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(state, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+        self.last_commit = time.monotonic()
+
+    def remove(self):
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+
+class ProcessEngine(object):
+    ''' 每个worker一个进程，队列需要能跨进程传递数据
+    '''
+
+    def queue(self):
+        return Queue()
+
+    def start(self, target):
+        worker = Process(target=target)
+        worker.start()
+        return worker
+
+
+class ThreadEngine(object):
+    ''' 每个worker是master进程中的一个线程
+
+    PyCryptodome的加解密以及zlib、lzma的压缩在处理大块数据时会释放GIL，
+    线程之间同样可以并行。数据块在线程之间直接传递引用，没有fork和pickle的开销
+    '''
+
+    def queue(self):
+        return LocalQueue()
+
+    def start(self, target):
+        worker = Thread(target=target, daemon=True)
+        worker.start()
+        return worker
+
+
+engine_map = {
+        'processes': ProcessEngine,
+        'threads': ThreadEngine,
+        }
 
 
 class Worker(object):
@@ -181,150 +1362,1707 @@ class Worker(object):
                  resp_queue,
                  crypto_obj,
                  output_handler,
+                 transport,
+                 source_file,
                  opt_type='encrypt',
-                 serial=None):
+                 serial=None,
+                 batch_time=None,
+                 max_batch_size=4096,
+                 container=False,
+                 engine=None,
+                 stats=None,
+                 hash_blocks=False):
         self.request_queue = request_queue
         self.resp_queue = resp_queue
         self.crypto_obj = crypto_obj
         self.output_handler = output_handler
+        self.transport = transport
+        self.source_file = source_file
         self.opt_type = opt_type
         self.serial = serial
+        # 加密时是否输出容器格式的record
+        self.container = container
+        self.engine = engine or ProcessEngine()
+        self.stats = stats
+        # 加密时顺带计算每个输出数据块的hash
+        self.hash_blocks = hash_blocks
+
+        # 每次请求的数据块数量，根据实测的单块处理耗时动态调整，
+        # 使每一次请求大约携带batch_time秒的工作量
+        self.batch_time = batch_time or 0.005
+        self.batch_size = 1
+        self.max_batch_size = max_batch_size
+        self.time_per_block = None
 
     def request_data(self):
-        self.request_queue.put(self.serial)
+        self.request_queue.put((self.serial, self.batch_size))
         return self.resp_queue.get()
 
+    def adjust_batch_size(self, count, elapsed):
+        time_per_block = elapsed / count
+        if self.time_per_block is None:
+            self.time_per_block = time_per_block
+        else:
+            # 平滑一下，避免单次的抖动让batch_size大起大落
+            self.time_per_block = (self.time_per_block + time_per_block) / 2
+
+        if self.time_per_block > 0:
+            batch_size = int(self.batch_time / self.time_per_block)
+        else:
+            batch_size = self.max_batch_size
+        self.batch_size = max(1, min(batch_size, self.max_batch_size))
+
+    def process(self, data, source_file=None, crypto_obj=None):
+        # 传给加密类型的serial是数据块在整个文件中的序号
+        # 批量模式下数据来自不同的文件，由调用者给出对应的源文件和加密类型对象
+        if source_file is None:
+            source_file = self.source_file
+        if crypto_obj is None:
+            crypto_obj = self.crypto_obj
+
+        if self.opt_type == 'verify':
+            # 只计算每个数据块的hash，不解密，也没有输出
+            data['hashes'] = [hashlib.sha256(unit).digest()
+                              for unit in split_units(source_file.get_span(data), data)]
+            return b''
+
+        if self.opt_type == 'decrypt':
+            # 记下这个batch中数据块的顺序，由写入线程检查前后是否衔接
+            order = BlockOrder()
+            res = self.__decrypt(data, source_file, crypto_obj, order)
+            data['order'] = order.state()
+            return res
+
+        if 'offset' in data:
+            blocks = source_file.get_blocks(data)
+        else:
+            blocks = self.transport.recv_input(data)
+        # 文件的最后一块带有结束标记
+        last = len(blocks) - 1 if data.get('last') else None
+
+        if self.container:
+            # 容器格式中的record不做文本编码，同时记下每块的大小用于生成索引
+            records = [Container.pack_record(crypto_obj.encrypt_block(block, data['serial'] + i, i == last))
+                       for i, block in enumerate(blocks)]
+            data['sizes'] = [(len(record), len(block))
+                             for record, block in zip(records, blocks)]
+            self.__hash(data, records)
+            return b''.join(records)
+
+        res = [crypto_obj.completely_encrypt(block, data['serial'] + i, i == last)
+               for i, block in enumerate(blocks)]
+        self.__hash(data, res)
+        return b''.join(res)
+
+    def __decrypt(self, data, source_file, crypto_obj, order):
+        if data.get('records'):
+            first = source_file.record_base + data['serial']
+            records = Container.iter_records(source_file.get_span(data))
+            res = b''.join([crypto_obj.decrypt_block(record, first + i, order)
+                            for i, record in enumerate(records)])
+            if data['trim'] is not None:
+                res = res[data['trim'][0]: data['trim'][1]]
+            return res
+
+        if data.get('span'):
+            return crypto_obj.decrypt_span(source_file.get_span(data), order)
+
+        if data.get('frames'):
+            return crypto_obj.decrypt_frames(source_file.get_span(data),
+                                             data['serial'],
+                                             order)
+
+        blocks = self.transport.recv_input(data)
+        if data.get('rows') and crypto_obj.framing == 'binary':
+            # armor过的行与按映射分发的区间一样处理，行内的帧不对应块序号
+            res = [crypto_obj.decrypt_span(block, order) for block in blocks]
+            return b''.join(res)
+
+        res = [crypto_obj.completely_decrypt(block, data['serial'] + i, order)
+               for i, block in enumerate(blocks)]
+        return b''.join(res)
+
+    def __hash(self, data, units):
+        # 数据块刚刚算出来，还在缓存中，顺带算出hash
+        if self.hash_blocks:
+            data['hashes'] = [hashlib.sha256(unit).digest() for unit in units]
+
+    def send(self, data, res):
+        # 返回输出的字节数
+        data = self.transport.send_output(data, res)
+        self.output_handler.save(data)
+        return data['length']
+
     def work(self):
+        try:
+            while True:
+                started = time.perf_counter()
+                data = self.request_data()
+                if not data:
+                    break
+
+                requested = time.perf_counter()
+                res = self.process(data)
+                processed = time.perf_counter()
+                size = self.send(data, res)
+                sent = time.perf_counter()
+
+                self.adjust_batch_size(data['count'], sent - requested)
+                if self.stats is not None:
+                    self.stats.add_worker(self.serial,
+                                          data['count'],
+                                          size,
+                                          processed - requested,
+                                          requested - started,
+                                          sent - processed)
+        except Exception as e:
+            # 把出错原因当作请求发给master，否则所有worker都出错时master会一直等待请求
+            self.request_queue.put((self.serial, '%s: %s' % (e.__class__.__name__, e)))
+            raise
+        finally:
+            # 出错退出时也要通知写入线程，由它报告缺失的数据块
+            self.output_handler.save('EOF')
+
+    def start(self):
+        self.worker = self.engine.start(self.work)
+
+    def join(self):
+        if hasattr(self, 'worker'):
+            self.worker.join()
+            return True
+
+
+class BatchWorker(Worker):
+    ''' 批量模式的worker，一个batch中的数据可能来自多个文件
+    '''
+
+    def process(self, data):
+        for item in data['items']:
+            source_file = PreadSource(item['path'], item['bs'])
+            crypto_obj = self.crypto_obj.with_salt(item['salt'])
+            try:
+                res = super().process(item, source_file, crypto_obj)
+            except Exception as e:
+                # 一个文件出错不影响其他文件，由写入线程丢弃这个文件
+                item['error'] = '%s: %s' % (e.__class__.__name__, e)
+                res = b''
+            self.transport.send_output(item, res)
+        return data
+
+    def send(self, data, res):
+        # 每一项的结果已经放在各自的item中
+        self.output_handler.save(data)
+        return sum(item['length'] for item in data['items'])
+
+
+class QueueTransport(object):
+    ''' 数据块本身随队列传递，需要经过两次pickle
+    '''
+
+    # 一个batch中所有数据块的总字节数上限
+    max_batch_bytes = 4 * 1024 * 1024
+
+    def send_input(self, data):
+        return data
+
+    def recv_input(self, data):
+        return data['blocks']
+
+    def send_output(self, data, res):
+        # 输入数据不用再传回去
+        data.pop('blocks', None)
+        data['block'] = res
+        data['length'] = len(res)
+        return data
+
+    def recv_output(self, data):
+        return data['block']
+
+    def release(self, data):
+        pass
+
+    def abort(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class SlotRing(object):
+    ''' 由固定大小的槽位组成的一块共享内存
+    '''
+
+    def __init__(self, slots, slot_size):
+        self.slots = slots
+        self.slot_size = slot_size
+        self.shm = SharedMemory(create=True, size=slots * slot_size)
+
+    def view(self, slot, length):
+        start = slot * self.slot_size
+        return self.shm.buf[start: start + length]
+
+    def write(self, slot, data):
+        self.view(slot, len(data))[:] = data
+
+    def close(self):
+        self.shm.close()
+        self.shm.unlink()
+
+
+class ShmTransport(object):
+    ''' 数据块放在共享内存的槽位中，队列中只传递槽位编号、长度和serial
+
+    输入和输出各有一个SlotRing，同一编号的输入槽和输出槽属于同一个batch。
+    槽位由master在分发数据前取得，由写入线程在数据写入文件后归还，
+    因此槽位的数量同时也限制了同时在处理中的batch数量。
+    放不进槽位的batch会退回到直接经由队列传递。
+    '''
+
+    def __init__(self, slots, slot_size=None):
+        slot_size = slot_size or 64 * 1024
+        # 一个batch要能整个放进一个槽位
+        self.max_batch_bytes = slot_size
+        self.in_ring = SlotRing(slots, slot_size)
+        # 输出可能比输入大(如base64)，给输出槽留出足够的余量
+        self.out_ring = SlotRing(slots, slot_size * 2 + 64)
+
+        # master和写入线程在同一进程中，用线程队列即可
+        self.free_slots = LocalQueue()
+        for slot in range(slots):
+            self.free_slots.put(slot)
+
+    def send_input(self, data):
+        if 'offset' in data:
+            # worker直接从源文件的映射中读取数据，只需要占一个输出槽位
+            data['slot'] = self.__take_slot()
+            return data
+
+        lengths = [len(block) for block in data['blocks']]
+        if sum(lengths) > self.in_ring.slot_size:
+            data['slot'] = None
+            return data
+
+        # batch中的数据块首尾相接地放进同一个槽位
+        slot = self.__take_slot()
+        if slot is None:
+            data['slot'] = None
+            return data
+        view = self.in_ring.view(slot, sum(lengths))
+        offset = 0
+        for block, length in zip(data['blocks'], lengths):
+            view[offset: offset + length] = block
+            offset += length
+        view.release()
+        return {
+                'serial': data['serial'],
+                'count': data['count'],
+                'rows': data['rows'],
+                'last': data['last'],
+                'slot': slot,
+                'lengths': lengths,
+                }
+
+    def recv_input(self, data):
+        if data['slot'] is None:
+            return data['blocks']
+
+        view = self.in_ring.view(data['slot'], sum(data['lengths']))
+        blocks = []
+        offset = 0
+        for length in data['lengths']:
+            blocks.append(view[offset: offset + length])
+            offset += length
+        return blocks
+
+    def send_output(self, data, res):
+        data['length'] = len(res)
+        if data['slot'] is None or len(res) > self.out_ring.slot_size:
+            data['block'] = res
+        else:
+            self.out_ring.write(data['slot'], res)
+            data.pop('blocks', None)
+        return data
+
+    def recv_output(self, data):
+        if 'block' in data:
+            return data['block']
+        return self.out_ring.view(data['slot'], data['length'])
+
+    def __take_slot(self):
+        # 取到None说明已经abort，放回去留给下一次，batch退回到经由队列传递
+        slot = self.free_slots.get()
+        if slot is None:
+            self.free_slots.put(None)
+        return slot
+
+    def release(self, data):
+        if data['slot'] is not None:
+            self.free_slots.put(data['slot'])
+
+    def abort(self):
+        # 出错的worker占着的槽位不会再归还，master不能再等待槽位
+        self.free_slots.put(None)
+
+    def close(self):
+        self.in_ring.close()
+        self.out_ring.close()
+
+
+class WriterThreadMixin(object):
+    ''' 在master进程中的写入线程里运行work，worker通过save把结果交给它
+    '''
+
+    def _get_buffered_data(self):
+        # 阻塞等待第一个数据，然后把队列中现有的数据一次性取完
+        data_list = [self.buffer_.get()]
         while True:
-            data = self.request_data()
-            if data:
-                if self.opt_type == 'encrypt':
-                    res = self.crypto_obj.completely_encrypt(data['block'])
-                else: # self.opt_type == 'decrypt'
-                    res = self.crypto_obj.completely_decrypt(data['block'])
+            try:
+                data_list.append(self.buffer_.get_nowait())
+            except Empty:
+                return data_list
 
-                data['block'] = res
-                self.output_handler.save(data)
-            else:
-                self.output_handler.save('EOF')
-                break
+    def work(self):
+        raise NotImplementedError
+
+    def __run(self):
+        try:
+            self.work()
+        except Exception as e:
+            self.error = e
+
+    # 收到了所有worker的结束标识，此后worker都已结束
+    workers_stopped = False
+    # 写入线程在运行中发现的错误，master看到后停止分发。
+    # master读取输入出错时也记在这里，写入线程看到后不再写入
+    failed = None
 
     def start(self):
-        self.worker = Process(target=self.work)
+        self.error = None
+        self.worker = Thread(target=self.__run)
         self.worker.start()
 
     def join(self):
         if hasattr(self, 'worker'):
             self.worker.join()
+            # 写入线程中的异常在这里抛给master
+            if self.error is not None:
+                raise self.error
             return True
 
 
-class OutputHandler(object):
-    def __init__(self, output_file_path, number_of_worker):
-        self.data_serial = 0
-        self.evt = Event()
-
-        self.output_file = open(output_file_path, 'wb')
+class FileWriter(object):
+    ''' 把一个文件的处理结果按serial顺序写入输出文件
+    '''
 
+    def __init__(self,
+                 output_file_path,
+                 transport,
+                 container=None,
+                 armor=False,
+                 journal=None,
+                 resume_state=None,
+                 stats=None,
+                 merkle=None,
+                 order=None):
+        # '-'表示写到标准输出
+        if output_file_path == '-':
+            self.output_file = sys.stdout.buffer
+        elif resume_state is not None:
+            # 续传时丢弃最后一次记入日志之后写入的内容
+            self.output_file = open(output_file_path, 'r+b')
+            self.output_file.truncate(resume_state['output_offset'])
+            self.output_file.seek(resume_state['output_offset'])
+        else:
+            self.output_file = open(output_file_path, 'wb')
+        self.transport = transport
+        self.journal = journal
+        self.stats = stats
+        self.start_serial = 0
+        self.current_serial = 0
+        # 已写入的数据对应的输入偏移
+        self.input_offset = 0
+        if resume_state is not None:
+            self.start_serial = resume_state['serial']
+            self.input_offset = resume_state['input_offset']
+        elif journal is not None:
+            # 上一次留下的日志与重新开始的输出不再对应
+            journal.remove()
+        # 对每次写入的一整段输出做一次base64，每段单独成行
+        self.armor = armor
+
+        # 输出为容器格式时，container为写入header中的参数。
+        # 写入时记下每个数据块的偏移，最后追加在文件末尾作为索引
+        self.container = container
+        self.index = array('Q')
+        self.file_offset = 0
+        self.plain_offset = 0
+
+        # merkle不为None时按顺序把每个数据块的hash加入Merkle树。
+        # 其中的path不为None时，叶子边写边存入path旁的叶子文件，关闭时以params为内容在path保存manifest；
+        # expected不为None时逐个与这个叶子文件比较。树在open时建立
+        self.merkle = merkle
+        self.merkle_tree = None
+
+        # 解密带结束标记的加密类型时检查数据块的顺序，
+        # order为'continuous'时只检查前后衔接，为'complete'时还要求以最后一块结束
+        # 从头开始解密整个文件时，第一块必须是0号块
+        self.order = order
+        self.block_order = None
+        if order is not None:
+            first = 0 if order == 'complete' and resume_state is None else None
+            self.block_order = BlockOrder(first)
+
+    def _flush(self, blocks):
+        data = b''.join(blocks)
+        if self.armor:
+            data = b64.standard_b64encode(data) + b'\n'
+        started = time.perf_counter()
+        self.output_file.write(data)
+        if self.stats is not None:
+            self.stats.add_flush(len(data), time.perf_counter() - started)
+
+    def __update_index(self, run):
+        for data in run:
+            for record_len, plain_len in data['sizes']:
+                self.index.append(self.file_offset)
+                self.index.append(self.plain_offset)
+                self.file_offset += record_len
+                self.plain_offset += plain_len
+
+    def pop_run(self, window):
+        # 从以serial为键的最小堆中取出从current_serial开始的连续数据
+        # 每个数据覆盖[serial, serial + count)这一段连续的数据块
+        run = []
+        current_serial = self.current_serial
+        while window and window[0][0] == current_serial:
+            data = heapq.heappop(window)[1]
+            run.append(data)
+            current_serial += data['count']
+        return run
+
+    def open(self):
+        self.current_serial = self.start_serial
+        if self.merkle is not None:
+            leaves_path = None
+            if self.merkle['path'] is not None:
+                leaves_path = MerkleTree.leaves_path(self.merkle['path'])
+            self.merkle_tree = MerkleTree(leaves_path, self.merkle.get('expected'))
+        if self.container is not None:
+            header = Container.pack_header(self.container)
+            self.output_file.write(header)
+            self.file_offset = len(header)
+
+    def write_run(self, run):
+        # run为从current_serial开始的一段连续数据，一次写入
+        # 顺序不对或hash与manifest不一致时在写入任何东西之前抛出ValueError
+        if self.block_order is not None:
+            for data in run:
+                if data.get('order') is not None:
+                    self.block_order.extend(data['order'])
+        if self.merkle_tree is not None:
+            for data in run:
+                self.merkle_tree.add(data['hashes'])
+
+        self.current_serial = run[-1]['serial'] + run[-1]['count']
+        self._flush([self.transport.recv_output(data) for data in run])
+        for data in run:
+            self.transport.release(data)
+        if self.container is not None:
+            self.__update_index(run)
+
+        self.input_offset = run[-1].get('end', self.input_offset)
+        if self.journal is not None and self.journal.due():
+            self.journal.commit(self.output_file, self.current_serial, self.input_offset)
+
+    def __close_file(self):
+        if self.output_file is sys.stdout.buffer:
+            self.output_file.flush()
+        else:
+            self.output_file.close()
+
+    def abort(self):
+        # 出错时记下已连续写入的部分，修复后可以从这里继续
+        if self.journal is not None:
+            self.journal.commit(self.output_file, self.current_serial, self.input_offset)
+        self.__close_file()
+        # 写了一半的叶子文件没有对应的manifest，删掉
+        if self.merkle_tree is not None:
+            self.merkle_tree.close()
+            if self.merkle['path'] is not None:
+                leaves_path = MerkleTree.leaves_path(self.merkle['path'])
+                if os.path.exists(leaves_path):
+                    os.remove(leaves_path)
+
+    def close(self, missing=0):
+        # 所有worker都已停止，但窗口中仍有missing个数据，说明有数据块丢失
+        if missing:
+            self.abort()
+            raise RuntimeError(
+                'block %d is missing, %d blocks not written' % (self.current_serial, missing)
+            )
+        if self.order == 'complete' and not self.block_order.final:
+            self.abort()
+            raise ValueError('the last block is missing, the input is truncated')
+
+        if self.container is not None:
+            self.output_file.write(
+                Container.pack_index(self.index, self.file_offset, self.plain_offset)
+            )
+        self.__close_file()
+        if self.merkle_tree is not None:
+            self.merkle_tree.close()
+            if self.merkle['path'] is not None:
+                self.merkle_tree.save(self.merkle['path'], self.merkle['params'])
+        # 全部写完，不再需要日志
+        if self.journal is not None:
+            self.journal.remove()
+
+
+class OutputHandler(FileWriter, WriterThreadMixin):
+    def __init__(self,
+                 output_file_path,
+                 number_of_worker,
+                 transport,
+                 max_pending_bytes=None,
+                 container=None,
+                 armor=False,
+                 limiter=None,
+                 journal=None,
+                 resume_state=None,
+                 engine=None,
+                 stats=None,
+                 merkle=None,
+                 order=None):
+        super().__init__(output_file_path,
+                         transport,
+                         container=container,
+                         armor=armor,
+                         journal=journal,
+                         resume_state=resume_state,
+                         stats=stats,
+                         merkle=merkle,
+                         order=order)
+        self.limiter = limiter
         self.max_EFO_times = number_of_worker
-        self.buffer_ = Queue()
+        self.buffer_ = (engine or ProcessEngine()).queue()
+        # 分发完毕后由master设为结束处的块序号，出错停止分发时为None
+        self.end_serial = None
+
+        # 乱序窗口中允许积压的最大字节数
+        # 超出后worker会在save中阻塞，以此对过快的worker形成背压
+        self.max_pending_bytes = max_pending_bytes or 64 * 1024 * 1024
+        # 以下状态在worker进程与写入线程之间共享，均由cond保护
+        self.cond = Condition()
+        self.pending_bytes = Value('q', 0, lock=False)
+        self.next_serial = Value('q', self.start_serial, lock=False)
+        # 有worker退出后不再限制窗口，出错的worker丢失的数据块不会再来了
+        self.draining = Value('b', 0, lock=False)
+
+    def __can_accept(self, serial, size):
+        # 写入线程正在等待的块，以及窗口为空时的块总是放行，否则会死锁
+        if serial == self.next_serial.value or self.pending_bytes.value == 0:
+            return True
+        if self.draining.value:
+            return True
+        return self.pending_bytes.value + size <= self.max_pending_bytes
 
     def save(self, data):
+        if data != 'EOF':
+            size = data['length']
+            with self.cond:
+                while not self.__can_accept(data['serial'], size):
+                    self.cond.wait()
+                self.pending_bytes.value += size
+
         self.buffer_.put(data)
-        self.evt.set()
 
-    def _get_all_buffered_data(self):
-        return [self.buffer_.get() for i in range(self.buffer_.qsize())]
+    def __release(self, next_serial, size):
+        with self.cond:
+            self.pending_bytes.value -= size
+            self.next_serial.value = next_serial
+            self.cond.notify_all()
+
+    def __discard_run(self, run):
+        # 出错后丢弃worker的结果，但仍要释放它们占用的槽位和额度，worker才能结束
+        self.current_serial = run[-1]['serial'] + run[-1]['count']
+        for data in run:
+            self.transport.release(data)
+        if self.limiter is not None:
+            self.limiter.release(sum(data['count'] for data in run))
+        self.__release(self.current_serial, sum(data['length'] for data in run))
+
+    def __drain(self):
+        # worker只在没有数据了或出错时退出，没有数据时master已不再读取，不限制也无妨
+        if self.limiter is not None:
+            self.limiter.abort()
+        self.transport.abort()
+        with self.cond:
+            self.draining.value = 1
+            self.cond.notify_all()
+
+    def write_run(self, run):
+        super().write_run(run)
+        if self.limiter is not None:
+            self.limiter.release(sum(data['count'] for data in run))
+        self.__release(self.current_serial, sum(data['length'] for data in run))
 
     def work(self):
-        current_serial = 0
         EOF_times = 0
-        # 一次循环中未处理的数据将会存在这里，和下一轮循环中的数据合并起来一起处理
-        untreated = []
+        # 以serial为键的最小堆，存放尚未能写入的乱序数据
+        window = []
+
+        self.open()
+        while EOF_times < self.max_EFO_times:
+            for data in self._get_buffered_data():
+                if data == 'EOF':
+                    EOF_times += 1
+                    self.__drain()
+                else:
+                    heapq.heappush(window, (data['serial'], data))
+            if self.stats is not None:
+                self.stats.add_window(len(window))
+
+            run = self.pop_run(window)
+            if run and self.failed is None:
+                try:
+                    self.write_run(run)
+                    run = None
+                except ValueError as e:
+                    # 数据块的顺序不对，之后不再写入
+                    self.failed = e
+            if run:
+                self.__discard_run(run)
+        self.workers_stopped = True
+        if self.failed is not None:
+            # 记下已连续写入的位置
+            self.abort()
+            raise self.failed
+
+        # 窗口中剩下的数据块写不出去。最后几个batch出错时窗口是空的，
+        # 按master分发到的块序号检查
+        missing = sum(data['count'] for serial, data in window)
+        if self.end_serial is not None:
+            missing = self.end_serial - self.current_serial
+        self.close(missing)
+
+
+class BatchOutputHandler(WriterThreadMixin):
+    ''' 批量模式的写入线程，每个文件有各自的FileWriter和乱序窗口
+
+    master在分发一个文件的数据之前add_file，分发完之后finish_file，
+    写入线程在这个文件的数据全部写入后关闭它
+    '''
+
+    def __init__(self, number_of_worker, transport, limiter, armor=False, engine=None, stats=None, order=None):
+        self.transport = transport
+        self.limiter = limiter
+        self.armor = armor
+        self.stats = stats
+        self.order = order
+        self.max_EFO_times = number_of_worker
+        self.buffer_ = (engine or ProcessEngine()).queue()
+
+        # file_id -> 文件的状态，master线程和写入线程都会访问，由lock保护
+        self.files = {}
+        self.lock = Lock()
+        self.failures = []
+
+    def add_file(self, file_id, source_path, output_path, container=None):
+        output_dir = os.path.dirname(output_path)
+        if output_dir:
+            os.makedirs(output_dir, exist_ok=True)
+        writer = FileWriter(output_path,
+                            self.transport,
+                            container=container,
+                            armor=self.armor,
+                            stats=self.stats,
+                            order=self.order)
+        writer.open()
+        with self.lock:
+            self.files[file_id] = {
+                    'writer': writer,
+                    'window': [],
+                    'end_serial': None,
+                    'source_path': source_path,
+                    'output_path': output_path,
+                    }
 
-        while True:
-            data_list = self._get_all_buffered_data()
-            if not (data_list or untreated):
-                continue
+    def finish_file(self, file_id, end_serial):
+        with self.lock:
+            state = self.files.get(file_id)
+            if state is not None:
+                state['end_serial'] = end_serial
+        # 这个文件的数据可能早已全部写入，唤醒写入线程关闭它
+        self.buffer_.put({'file': file_id})
+
+    def fail(self, source_path, error):
+        with self.lock:
+            self.failures.append((source_path, str(error)))
 
-            # 查看并去除EOF标识
-            if 'EOF' in data_list:
-                current_EOF_times = data_list.count('EOF')
-                EOF_times += current_EOF_times
-                for i in range(current_EOF_times):
-                    data_list.remove('EOF')
-
-            # 将上一轮未处理的数据和本次数据合并，一起排序
-            data_list += untreated
-            untreated = []
-            data_list.sort(key=lambda x: x['serial'])
-
-            data_to_write = b''
-            for d in data_list:
-                # 若数据序号和当前序号不同，则是出现断片，break之后读取后续数据
-                if data_list[0]['serial'] == current_serial:
-                    data_to_write += data_list.pop(0)['block']
-                    current_serial += 1
+    def fail_file(self, file_id, error):
+        # master读取这个文件出错，同worker出错一样交给写入线程丢弃这个文件，
+        # 已分发出去的数据块随后到来时也一并丢弃
+        item = {'file': file_id, 'count': 0, 'error': '%s: %s' % (error.__class__.__name__, error)}
+        self.buffer_.put({'items': [item]})
+
+    def save(self, data):
+        self.buffer_.put(data)
+
+    def __drop(self, file_id, error):
+        # 出错文件的输出是不完整的，删掉
+        with self.lock:
+            state = self.files.pop(file_id, None)
+        if state is None:
+            return
+        self.limiter.release(sum(item['count'] for serial, item in state['window']))
+        state['writer'].abort()
+        try:
+            os.remove(state['output_path'])
+        except OSError:
+            pass
+        self.fail(state['source_path'], error)
+
+    def __push(self, item):
+        with self.lock:
+            state = self.files.get(item['file'])
+        if state is None or 'error' in item:
+            # 文件已经出错被丢弃了
+            self.limiter.release(item['count'])
+            if state is not None:
+                self.__drop(item['file'], item['error'])
+            return
+        heapq.heappush(state['window'], (item['serial'], item))
+
+    def __write(self, file_id):
+        with self.lock:
+            state = self.files.get(file_id)
+        if state is None:
+            return
+
+        writer = state['writer']
+        try:
+            run = writer.pop_run(state['window'])
+            if run:
+                writer.write_run(run)
+                self.limiter.release(sum(data['count'] for data in run))
+            if writer.current_serial == state['end_serial']:
+                writer.close()
+                with self.lock:
+                    del self.files[file_id]
+        except (OSError, ValueError) as e:
+            self.__drop(file_id, e)
+
+    def work(self):
+        EOF_times = 0
+        while EOF_times < self.max_EFO_times:
+            touched = set()
+            for data in self._get_buffered_data():
+                if data == 'EOF':
+                    EOF_times += 1
+                    # 同OutputHandler，出错的worker拿走的数据块不会再释放
+                    self.limiter.abort()
+                elif 'items' in data:
+                    for item in data['items']:
+                        self.__push(item)
+                        touched.add(item['file'])
                 else:
-                    break
+                    touched.add(data['file'])
+
+            for file_id in touched:
+                self.__write(file_id)
+        self.workers_stopped = True
+
+        # 所有worker都已停止，还没写完的文件缺少了数据块
+        with self.lock:
+            remaining = list(self.files)
+        for file_id in remaining:
+            self.__write(file_id)
+        with self.lock:
+            remaining = list(self.files)
+        for file_id in remaining:
+            self.__drop(file_id, 'blocks are missing')
+
+
+def pack_varint(value):
+    res = bytearray()
+    while value >= 0x80:
+        res.append(value & 0x7f | 0x80)
+        value >>= 7
+    res.append(value)
+    return bytes(res)
+
+
+def unpack_varint(buf, offset=0):
+    # 返回解出的值，以及varint之后的偏移
+    value = 0
+    shift = 0
+    while True:
+        if offset >= len(buf):
+            raise ValueError('varint is truncated')
+        byte = buf[offset]
+        offset += 1
+        value |= (byte & 0x7f) << shift
+        if not byte & 0x80:
+            return value, offset
+        shift += 7
+
+
+def read_varint(fp):
+    # 从文件中读出一个varint，文件在varint开始之前就结束时返回None
+    value = 0
+    shift = 0
+    while True:
+        byte = fp.read(1)
+        if not byte:
+            if shift:
+                raise ValueError('varint is truncated')
+            return None
+        value |= (byte[0] & 0x7f) << shift
+        if not byte[0] & 0x80:
+            return value
+        shift += 7
+
+
+def iter_frames(buf):
+    offset = 0
+    while offset < len(buf):
+        length, offset = unpack_varint(buf, offset)
+        if offset + length > len(buf):
+            raise ValueError('frame is truncated')
+        yield buf[offset: offset + length]
+        offset += length
+
+
+class PwriteOutputHandler(object):
+    ''' 输出大小只取决于输入大小时，第serial块的输出位置可以预先算出来
+
+    输出文件预先分配好空间，worker在save中直接把结果pwrite到对应的位置，
+    不再需要乱序窗口和写入线程。队列中只传递worker结束的标识
+    '''
+
+    workers_stopped = False
+    failed = None
 
-            self.output_file.write(data_to_write)
+    def __init__(self,
+                 output_file_path,
+                 number_of_worker,
+                 unit_size,
+                 output_size,
+                 block_count,
+                 engine=None):
+        # 文件描述符在fork出worker之前打开，worker进程会继承它
+        self.fd = os.open(output_file_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666)
+        try:
+            os.posix_fallocate(self.fd, 0, output_size)
+        except (AttributeError, OSError):
+            # 不支持fallocate的平台或文件系统，以及output_size为0时
+            os.ftruncate(self.fd, output_size)
+
+        self.unit_size = unit_size
+        self.block_count = block_count
+        self.max_EFO_times = number_of_worker
+        self.buffer_ = (engine or ProcessEngine()).queue()
+        self.written_blocks = Value('q', 0)
 
-            # 保存没有处理完的数据
-            if data_list:
-                untreated = data_list
+    def save(self, data):
+        if data == 'EOF':
+            self.buffer_.put(data)
+            return
 
-            # 所有worker都已停止，所有数据都已处理完毕，退出
-            if EOF_times == self.max_EFO_times and not untreated:
-                self.output_file.close()
-                break
+        view = memoryview(data['block'])
+        offset = data['serial'] * self.unit_size
+        while view:
+            written = os.pwrite(self.fd, view, offset)
+            view = view[written:]
+            offset += written
 
-            self.evt.wait(timeout=0.1)
+        with self.written_blocks.get_lock():
+            self.written_blocks.value += data['count']
 
     def start(self):
-        self.worker = Thread(target=self.work)
-        self.worker.start()
+        pass
 
     def join(self):
-        if hasattr(self, 'worker'):
-            self.worker.join()
-            return True
+        for i in range(self.max_EFO_times):
+            self.buffer_.get()
+        self.workers_stopped = True
+        os.close(self.fd)
+
+        if self.failed is not None:
+            raise self.failed
+        if self.written_blocks.value != self.block_count:
+            raise RuntimeError(
+                '%d of %d blocks not written'
+                % (self.block_count - self.written_blocks.value, self.block_count)
+            )
+        return True
+
+
+class Container(object):
+    ''' 可随机访问的容器格式
+
+    header:  MAGIC(4s) | VERSION(u8) | 参数长度(u32) | 参数(json)
+    records: 加密后数据块的长度(u32) | 加密后的数据块，按serial依次排列
+    index:   每个数据块一项，record在文件中的偏移(u64) | 在明文中的偏移(u64)
+    trailer: index的偏移(u64) | 数据块数量(u64) | 明文总长度(u64) | INDEX_MAGIC(4s)
+
+    header中的参数记录了加密类型和块大小。
+    读取时只需解析header和文件末尾的索引，即可定位任意一段明文所在的record
+    '''
+
+    MAGIC = b'SCC\x00'
+    INDEX_MAGIC = b'SCI\x00'
+    VERSION = 1
+
+    HEADER = struct.Struct('>4sBI')
+    RECORD = struct.Struct('>I')
+    ENTRY = struct.Struct('>QQ')
+    TRAILER = struct.Struct('>QQQ4s')
+
+    def __init__(self, buf):
+        magic, version, params_len = self.HEADER.unpack_from(buf, 0)
+        if magic != self.MAGIC:
+            raise ValueError('not a simple_crypto container')
+        if version != self.VERSION:
+            raise ValueError('unsupported container version: %d' % version)
+        self.params = json.loads(buf[self.HEADER.size: self.HEADER.size + params_len])
+
+        if len(buf) < self.HEADER.size + params_len + self.TRAILER.size:
+            raise ValueError('container is truncated')
+        index_offset, count, plain_size, index_magic = self.TRAILER.unpack_from(
+            buf, len(buf) - self.TRAILER.size
+        )
+        if index_magic != self.INDEX_MAGIC:
+            raise ValueError('container index is missing or corrupted')
+
+        entries = array('Q')
+        entries.frombytes(buf[index_offset: index_offset + count * self.ENTRY.size])
+        if sys.byteorder == 'little':
+            entries.byteswap()
+
+        self.buf = buf
+        self.count = count
+        self.plain_size = plain_size
+        # 两者末尾各多放一项，分别是index的偏移和明文总长度，
+        # 这样第i块的范围总是[offsets[i], offsets[i + 1])
+        self.offsets = entries[0::2]
+        self.offsets.append(index_offset)
+        self.plains = entries[1::2]
+        self.plains.append(plain_size)
+
+    @classmethod
+    def is_container(cls, buf):
+        return buf[:len(cls.MAGIC)] == cls.MAGIC
+
+    @classmethod
+    def pack_header(cls, params):
+        params = json.dumps(params).encode('utf-8')
+        return cls.HEADER.pack(cls.MAGIC, cls.VERSION, len(params)) + params
+
+    @classmethod
+    def pack_record(cls, data):
+        return cls.RECORD.pack(len(data)) + data
+
+    @classmethod
+    def pack_index(cls, index, index_offset, plain_size):
+        count = len(index) // 2
+        index = array('Q', index)
+        if sys.byteorder == 'little':
+            index.byteswap()
+        trailer = cls.TRAILER.pack(index_offset, count, plain_size, cls.INDEX_MAGIC)
+        return index.tobytes() + trailer
+
+    @classmethod
+    def iter_records(cls, buf):
+        offset = 0
+        while offset < len(buf):
+            length, = cls.RECORD.unpack_from(buf, offset)
+            offset += cls.RECORD.size
+            yield buf[offset: offset + length]
+            offset += length
+
+    def locate(self, start, length):
+        # 返回包含明文[start, start + length)的数据块范围[first, last)
+        end = min(start + length, self.plain_size)
+        if start >= end:
+            return 0, 0
+        first = bisect_right(self.plains, start) - 1
+        last = bisect_left(self.plains, end)
+        return first, last
+
+    def read_range(self, crypto_obj, start, length):
+        first, last = self.locate(start, length)
+        if first == last:
+            return b''
+
+        records = self.buf[self.offsets[first]: self.offsets[last]]
+        res = b''.join([crypto_obj.decrypt_block(record, first + i)
+                        for i, record in enumerate(self.iter_records(records))])
+        skip = start - self.plains[first]
+        return res[skip: skip + length]
+
+
+def read_range(path, start, length, **kwargs):
+    ''' 在当前进程中从容器格式的文件里解密出明文的[start, start + length)
+
+    只读取覆盖这段明文的几个record，适合从大文件中取出一小段数据。
+    kwargs会传给加密类型的构造函数
+    '''
+
+    with open(path, 'rb') as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+            container = Container(buf)
+            crypto_class = crypto_type_map.get(container.params['crypto_type'])
+            crypto_obj = crypto_class(compression=container.params.get('compression'), **kwargs)
+            return container.read_range(crypto_obj, start, length)
+
+
+class MerkleTree(object):
+    ''' 由每个数据块的hash组成的Merkle树
+
+    叶子为输出中每个数据块按原样(含分帧)的SHA-256，
+    内部节点为SHA-256(0x01 | 左 | 右)，某一层为奇数个节点时最后一个直接升到上一层。
+    只保留各棵满二叉子树的根，随叶子的加入增量地计算，内存只与层数有关。
+    叶子依次写入manifest旁的叶子文件(每个32字节)，JSON格式的manifest只记录参数、叶子数量和根。
+    校验时边计算边与叶子文件比较，不需要密钥
+    '''
+
+    HASH_SIZE = 32
+
+    def __init__(self, leaves_path=None, expected_path=None):
+        # leaves_path不为None时把叶子依次写入这个文件，
+        # expected_path不为None时依次与这个文件中的叶子比较，不一致时抛出ValueError
+        self.count = 0
+        # 从左到右各棵满二叉子树的(高度, 根)，高度严格递减
+        self.peaks = []
+        self.leaves_file = open(leaves_path, 'wb') if leaves_path is not None else None
+        self.expected_file = open(expected_path, 'rb') if expected_path is not None else None
+
+    def __len__(self):
+        return self.count
+
+    @staticmethod
+    def leaves_path(path):
+        return path + '.leaves'
+
+    @staticmethod
+    def parent(left, right):
+        return hashlib.sha256(b'\x01' + left + right).digest()
+
+    def add(self, hashes):
+        for digest in hashes:
+            if self.expected_file is not None:
+                expected = self.expected_file.read(self.HASH_SIZE)
+                if not expected:
+                    raise ValueError('block %d is not in the manifest' % self.count)
+                if expected != digest:
+                    raise ValueError('block %d does not match the manifest' % self.count)
+            if self.leaves_file is not None:
+                self.leaves_file.write(digest)
+            # 与左边同样高度的子树合并，像二进制加一时的进位
+            height = 0
+            while self.peaks and self.peaks[-1][0] == height:
+                digest = self.parent(self.peaks.pop()[1], digest)
+                height += 1
+            self.peaks.append((height, digest))
+            self.count += 1
+
+    def root(self):
+        # 从右往左依次把较小的子树并到左边较大的子树下，
+        # 与逐层两两合并、奇数个时最后一个升到上一层的结果相同
+        if not self.peaks:
+            return hashlib.sha256(b'').digest()
+        root = self.peaks[-1][1]
+        for height, digest in reversed(self.peaks[:-1]):
+            root = self.parent(digest, root)
+        return root
+
+    def close(self):
+        for f in (self.leaves_file, self.expected_file):
+            if f is not None:
+                f.close()
+
+    def save(self, path, params):
+        # 叶子已经写在leaves_path(path)中
+        manifest = dict(params)
+        manifest['algorithm'] = 'sha256'
+        manifest['count'] = self.count
+        manifest['root'] = self.root().hex()
+        manifest['leaves'] = os.path.basename(self.leaves_path(path))
+        with open(path, 'w') as f:
+            json.dump(manifest, f)
+
+    @classmethod
+    def load(cls, path):
+        # 返回manifest中的内容和叶子文件的路径，叶子在校验时才逐个读出
+        # 叶子文件的大小与manifest不一致时抛出ValueError
+        with open(path, 'r') as f:
+            manifest = json.load(f)
+        if manifest.get('algorithm') != 'sha256':
+            raise ValueError('unsupported manifest algorithm: %s' % manifest.get('algorithm'))
+        if not isinstance(manifest.get('leaves'), str):
+            raise ValueError('manifest is corrupted: %s' % path)
+        leaves_path = os.path.join(os.path.dirname(path), manifest.pop('leaves'))
+        if os.path.getsize(leaves_path) != manifest['count'] * cls.HASH_SIZE:
+            raise ValueError('manifest is corrupted: %s' % leaves_path)
+        return manifest, leaves_path
+
+
+def split_units(buf, data):
+    # 按输出中的原样切出每个数据块，即文本格式的一行(含换行)、
+    # binary分帧的一帧(含长度前缀)或容器格式的一个record(含长度)
+    offset = 0
+    if data.get('records'):
+        while offset < len(buf):
+            length, = Container.RECORD.unpack_from(buf, offset)
+            end = offset + Container.RECORD.size + length
+            yield buf[offset: end]
+            offset = end
+    elif data.get('frames'):
+        while offset < len(buf):
+            length, payload = unpack_varint(buf, offset)
+            yield buf[offset: payload + length]
+            offset = payload + length
+    else:
+        yield from bytes(buf).splitlines(keepends=True)
+
+
+def verify(path, manifest_path=None, workers=1, engine='auto', **kwargs):
+    ''' 按manifest并行地校验path中每个数据块的hash，不解密，也不写出任何数据
+
+    校验通过时返回Merkle根，否则抛出ValueError
+    '''
+    manifest_path = manifest_path or path + '.merkle'
+    manifest, leaves_path = MerkleTree.load(manifest_path)
+
+    # 只用到分帧的方式，用不到密钥，加密类型任选一个即可
+    # 写入线程按顺序逐块与叶子文件比较，第一个不一致的块就会让它停下
+    m = Master(path,
+               'base64',
+               opt_type='verify',
+               output_file_path=os.devnull,
+               framing=manifest['framing'],
+               expected_leaves=leaves_path)
+    m.start(workers=workers, engine=engine, **kwargs)
+    actual = m.merkle_tree
+
+    if len(actual) != manifest['count']:
+        raise ValueError('%d blocks in the file, %d in the manifest' % (len(actual), manifest['count']))
+    # 每个叶子都一致而根不一致，说明叶子文件与manifest不是一起写出的
+    if actual.root().hex() != manifest['root']:
+        raise ValueError('manifest is corrupted: %s' % manifest_path)
+    return actual.root()
+
+
+class Compressor(object):
+    ''' 逐块压缩
+
+    压缩后的数据块：算法编号(u8) | 原始长度(varint) | 压缩后的数据
+    压缩后的长度即加密前数据块的剩余部分。压缩后没有变小的数据块以NONE原样保存，
+    解压时只看数据块自己记录的算法编号
+    '''
+
+    NONE = 0
+    ALGORITHMS = {
+            'zlib': 1,
+            'lzma': 2,
+            'zstd': 3,
+            }
+
+    def __init__(self, algorithm):
+        self.algorithm = algorithm
+        self.algorithm_id = self.ALGORITHMS[algorithm]
+        # zstd的压缩上下文不能在线程之间共享，每个线程第一次使用时各自创建
+        self.__local = local()
+
+    def __compress(self, data):
+        if self.algorithm == 'zlib':
+            return zlib.compress(data)
+        if self.algorithm == 'lzma':
+            return lzma.compress(data)
+        if not hasattr(self.__local, 'zstd'):
+            self.__local.zstd = zstandard.ZstdCompressor()
+        return self.__local.zstd.compress(data)
+
+    def compress(self, data):
+        compressed = self.__compress(data)
+        if len(compressed) >= len(data):
+            return bytes([self.NONE]) + pack_varint(len(data)) + bytes(data)
+        return bytes([self.algorithm_id]) + pack_varint(len(data)) + compressed
+
+    @classmethod
+    def decompress(cls, data):
+        algorithm_id = data[0]
+        size, offset = unpack_varint(data, 1)
+        compressed = data[offset:]
+
+        if algorithm_id == cls.NONE:
+            res = bytes(compressed)
+        elif algorithm_id == cls.ALGORITHMS['zlib']:
+            res = zlib.decompress(compressed, bufsize=max(size, 1))
+        elif algorithm_id == cls.ALGORITHMS['lzma']:
+            res = lzma.decompress(compressed)
+        elif algorithm_id == cls.ALGORITHMS['zstd']:
+            if zstandard is None:
+                raise ValueError('block is compressed with zstd, but zstandard is not installed')
+            res = zstandard.ZstdDecompressor().decompress(compressed, max_output_size=size)
+        else:
+            raise ValueError('unknown compression algorithm: %d' % algorithm_id)
+
+        if len(res) != size:
+            raise ValueError('decompressed size mismatch: %d != %d' % (len(res), size))
+        return res
+
+
+class BlockOrder(object):
+    ''' 解密时检查数据块的顺序
+
+    带认证的加密类型在每个数据块中记下salt、块序号以及是否为最后一块，三者都经过认证。
+    worker检查一个batch之内的数据块是否连续，写入线程再把各个batch按顺序接起来，
+    检查前后是否衔接、文件是否以最后一块结束，数据块被挪动、删除或截断时都能发现
+    '''
+
+    def __init__(self, first=None):
+        # first为期望的第一块的序号，None时不限
+        self.salt = None
+        self.first = None
+        self.next = first
+        self.final = False
+
+    def add(self, salt, serial, last):
+        if self.final:
+            raise ValueError('block %d follows the last block' % serial)
+        if self.salt is None:
+            self.salt = salt
+        elif salt != self.salt:
+            raise ValueError('block %d is from another file' % serial)
+        if self.next is not None and serial != self.next:
+            raise ValueError('block %d is out of place, expected block %d' % (serial, self.next))
+        if self.first is None:
+            self.first = serial
+        self.next = serial + 1
+        self.final = last
+
+    def state(self):
+        # 随batch的结果交给写入线程，没有数据块时为None
+        if self.first is None:
+            return None
+        return (self.salt, self.first, self.next, self.final)
+
+    def extend(self, state):
+        # 接上后一个batch的state
+        salt, first, next_serial, final = state
+        self.add(salt, first, False)
+        self.next = next_serial
+        self.final = final
 
 
 class CryptoClassMixin(object):
-    def __init__(self, *args, **kwargs):
+    # 数据块中是否带有经过认证的块序号和结束标记，解密时据此检查顺序和截断
+    BLOCK_ORDER = False
+    # 需要密钥的加密类型这次运行使用的salt
+    salt = None
+
+    def __init__(self, *args, framing='text', compression=None, **kwargs):
         self.a = 0
+        self.framing = framing
+        self.compressor = Compressor(compression) if compression else None
 
-    def completely_encrypt(self, data):
-        encrypted = self.encrypt(data)
+    # serial为数据块在文件中的序号，需要逐块派生nonce的加密类型会用到它，
+    # last表示这是文件的最后一块。解密时order不为None则把数据块记入其中
+    def completely_encrypt(self, data, serial=None, last=False):
+        encrypted = self.encrypt_block(data, serial, last)
         return self.after_encrypt(encrypted)
 
-    def completely_decrypt(self, data):
+    def completely_decrypt(self, data, serial=None, order=None):
         real_data = self.before_decrypt(data)
-        return self.decrypt(real_data)
+        return self.decrypt_block(real_data, serial, order)
+
+    # 不含分帧的单个数据块的加解密，开启压缩时在加密前压缩、解密后解压
+    def encrypt_block(self, data, serial=None, last=False):
+        if self.compressor is not None:
+            data = self.compressor.compress(data)
+        return self.encrypt(data, serial, last)
+
+    def decrypt_block(self, data, serial=None, order=None):
+        res = self.decrypt(data, serial, order)
+        if self.compressor is not None:
+            res = Compressor.decompress(res)
+        return res
 
     def after_encrypt(self, data):
+        if self.framing == 'binary':
+            return pack_varint(len(data)) + data
         return b64.standard_b64encode(data) + b'\n'
 
     def before_decrypt(self, data):
-        return b64.standard_b64decode(data.rstrip(b'\n'))
+        # binary分帧时长度前缀已经在解析帧时去掉了
+        if self.framing == 'binary':
+            return data
+        # 行尾的换行符会被a2b_base64忽略，data也可以是memoryview
+        return b64.standard_b64decode(data)
+
+    def encrypted_size(self, size):
+        # encrypt输出的大小，无法预先确定时返回None
+        return size
+
+    def key_fingerprint(self):
+        # 用于确认续传时使用的是同一个密钥，没有密钥的加密类型返回None
+        return None
+
+    def new_salt(self):
+        # 批量模式下每个文件各自使用的salt，不需要密钥的加密类型返回None
+        return None
 
-    def encrypt(self, data):
+    def with_salt(self, salt):
+        return self
+
+    def output_size(self, size):
+        # 加密size字节的明文后，completely_encrypt输出的大小
+        if self.compressor is not None:
+            return None
+        size = self.encrypted_size(size)
+        if size is None:
+            return None
+        if self.framing == 'binary':
+            return len(pack_varint(size)) + size
+        return -(-size // 3) * 4 + 1
+
+    def decrypt_frames(self, buf, serial=None, order=None):
+        # buf由若干完整的帧组成，serial为第一帧的序号
+        return b''.join([self.decrypt_block(frame, None if serial is None else serial + i, order)
+                         for i, frame in enumerate(iter_frames(buf))])
+
+    def decrypt_span(self, span, order=None):
+        lines = [line for line in bytes(span).split(b'\n') if line]
+        # armor过的binary分帧，每一行是一整段帧的base64
+        if self.framing == 'binary':
+            return b''.join([self.decrypt_frames(b64.standard_b64decode(line), order=order)
+                             for line in lines])
+        # span由若干完整的行组成，每一行是一个加密后的数据块
+        return b''.join([self.completely_decrypt(line, order=order) for line in lines])
+
+    def encrypt(self, data, serial=None, last=False):
         return data
 
-    def decrypt(self, data):
+    def decrypt(self, data, serial=None, order=None):
         return data
 
 
 class CryptoBase64(CryptoClassMixin):
-    def encrypt(self, data):
+    def encrypt(self, data, serial=None, last=False):
         return b64.b64encode(data)
 
-    def decrypt(self, data):
+    def decrypt(self, data, serial=None, order=None):
         return b64.b64decode(data)
 
+    def encrypted_size(self, size):
+        return -(-size // 3) * 4
+
+    def decrypt_span(self, span, order=None):
+        # 没有填充的base64拼接起来仍然是合法的base64，且换行会被忽略，
+        # 所以不带'='的行可以整段一次解码，从第一个带'='的行开始逐行处理。
+        # 每一行是bs字节经过两次base64的结果，长度为4 * ceil(4 * ceil(bs / 3) / 3)，
+        # 只有4 * ceil(bs / 3)是3的倍数，即bs是9的倍数(如72、4608)时，行才不带填充，
+        # 此时只有文件的最后一块可能带填充。默认的64以及100、1000、4096等
+        # 每一行都带填充，整段都逐行处理
+        if self.framing != 'text' or self.compressor is not None:
+            return super().decrypt_span(span, order)
+
+        span = bytes(span)
+        padding = span.find(b'=')
+        cut = len(span) if padding == -1 else span.rfind(b'\n', 0, padding) + 1
+        head, tail = span[:cut], span[cut:]
+
+        res = []
+        if head:
+            encoded = b64.standard_b64decode(head)
+            if b'=' in encoded:
+                # 内层的每一块都带有填充(bs不是3的倍数)，
+                # 按内层每块的固定长度切开后逐块解码
+                line_len = len(head.split(b'\n', 1)[0]) // 4 * 3
+                res.extend(b64.b64decode(encoded[i: i + line_len])
+                           for i in range(0, len(encoded), line_len))
+            else:
+                res.append(b64.b64decode(encoded))
+
+        res.append(super().decrypt_span(tail, order))
+        return b''.join(res)
+
+
+class CryptoAEADMixin(CryptoClassMixin):
+    ''' 带认证的加密，每个数据块独立加密、独立校验
+
+    加密后的数据块：salt(16) | 块序号(u64) | 密文 | tag(16)
+    每次运行随机生成16字节的salt，用HKDF从密钥和salt派生出这次运行使用的子密钥，
+    nonce只由块序号组成。块序号保证同一个子密钥下nonce不重复，
+    不同的运行即使使用同一个密钥，子密钥也各不相同。
+    块序号的最高位标记文件的最后一块，它是nonce的一部分，同样经过认证；
+    空文件也会输出一个空的最后一块，因此截断总能被发现。
+    salt和块序号随数据块一起保存，因此解密时不需要知道块序号也能逐块并行处理，
+    再由BlockOrder检查数据块是否连续、是否完整；
+    知道块序号时(如容器格式)还会直接检查数据块是否被挪动了位置。
+
+    密钥在master中读入，随加密类型对象一起被worker进程继承
+    '''
+
+    SALT_SIZE = 16
+    SERIAL_SIZE = 8
+    HEADER_SIZE = SALT_SIZE + SERIAL_SIZE
+    TAG_SIZE = 16
+    LAST_FLAG = 1 << 63
+    KEY_SIZES = (32, )
+    BLOCK_ORDER = True
+
+    def __init__(self, key=None, key_file=None, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        if key_file:
+            with open(key_file, 'r') as f:
+                key = f.read().strip()
+        # 密钥可以是bytes，也可以是十六进制字符串
+        if isinstance(key, str):
+            key = bytes.fromhex(key)
+        if key is None:
+            raise ValueError('%s needs a key' % self.__class__.__name__)
+        if len(key) not in self.KEY_SIZES:
+            raise ValueError('invalid key length: %d bytes' % len(key))
+
+        self.key = key
+        self.salt = get_random_bytes(self.SALT_SIZE)
+        # 最近一次派生的(salt, 子密钥)，整体替换，线程之间共享也不会读到一半
+        self.subkey = (self.salt, self.derive_subkey(self.salt))
+
+    def new_cipher(self, subkey, nonce):
+        raise NotImplementedError
+
+    def derive_subkey(self, salt):
+        return HKDF(self.key, len(self.key), salt, SHA256, context=b'simple_crypto block key')
+
+    def get_subkey(self, salt):
+        # 同一个文件中的数据块一般使用同一个salt，只缓存最近的一个
+        last_salt, subkey = self.subkey
+        if salt != last_salt:
+            subkey = self.derive_subkey(salt)
+            self.subkey = (salt, subkey)
+        return subkey
+
+    def key_fingerprint(self):
+        return SHA256.new(b'simple_crypto key:' + self.key).hexdigest()[:16]
+
+    def new_salt(self):
+        return get_random_bytes(self.SALT_SIZE)
+
+    def with_salt(self, salt):
+        # 每个文件的块序号都从0开始，同一密钥下的不同文件必须使用不同的子密钥，
+        # 同一个文件的各个batch会先后交给同一个worker，子密钥沿用缓存
+        if salt is None:
+            return self
+        res = copy.copy(self)
+        res.salt = salt
+        res.subkey = (salt, self.get_subkey(salt))
+        return res
+
+    def encrypted_size(self, size):
+        return self.HEADER_SIZE + size + self.TAG_SIZE
+
+    @staticmethod
+    def nonce(serial_bytes):
+        return b'\0' * 4 + serial_bytes
+
+    def encrypt(self, data, serial=None, last=False):
+        if serial is None:
+            raise ValueError('%s needs the block serial' % self.__class__.__name__)
+
+        salt, subkey = self.subkey
+        serial_bytes = struct.pack('>Q', serial | self.LAST_FLAG if last else serial)
+        encrypted, tag = self.new_cipher(subkey, self.nonce(serial_bytes)).encrypt_and_digest(data)
+        return salt + serial_bytes + encrypted + tag
+
+    def decrypt(self, data, serial=None, order=None):
+        if len(data) < self.HEADER_SIZE + self.TAG_SIZE:
+            raise ValueError('block %s is truncated' % serial)
+
+        salt = bytes(data[:self.SALT_SIZE])
+        serial_bytes = bytes(data[self.SALT_SIZE: self.HEADER_SIZE])
+        value, = struct.unpack('>Q', serial_bytes)
+        block_serial = value & ~self.LAST_FLAG
+        if serial is not None and block_serial != serial:
+            raise ValueError('block %d is out of place' % serial)
+
+        encrypted = data[self.HEADER_SIZE: -self.TAG_SIZE]
+        tag = data[-self.TAG_SIZE:]
+        cipher = self.new_cipher(self.get_subkey(salt), self.nonce(serial_bytes))
+        try:
+            res = cipher.decrypt_and_verify(encrypted, tag)
+        except ValueError:
+            raise ValueError('block %d failed authentication' % block_serial)
+        if order is not None:
+            order.add(salt, block_serial, bool(value & self.LAST_FLAG))
+        return res
+
+
+class CryptoAESGCM(CryptoAEADMixin):
+    KEY_SIZES = (16, 24, 32)
+
+    def new_cipher(self, subkey, nonce):
+        return AES.new(subkey, AES.MODE_GCM, nonce=nonce, mac_len=self.TAG_SIZE)
+
+
+class CryptoChaCha20Poly1305(CryptoAEADMixin):
+    def new_cipher(self, subkey, nonce):
+        return ChaCha20_Poly1305.new(key=subkey, nonce=nonce)
+
+crypto_type_map = {
+        'base64': CryptoBase64,
+        'aes-gcm': CryptoAESGCM,
+        'chacha20-poly1305': CryptoChaCha20Poly1305,
+        }
+
+
+def write_stats(path, summary):
+    if not path:
+        return
+    if path == '-':
+        json.dump(summary, sys.stderr, indent=2)
+        sys.stderr.write('\n')
+    else:
+        with open(path, 'w') as f:
+            json.dump(summary, f, indent=2)
+
 
 if __name__ == '__main__':
-    m = Master('a', 'base64', opt_type='encrypt', output_file_path='encoded', bs=1024)
-    # m = Master('encoded', 'base64', opt_type='decrypt', output_file_path='decoded')
-    m.start(workers=4)
+    argp = argparse.ArgumentParser(
+                                prog='simple_crypto',
+                                description='一个多进程的分块加密工具',
+                                epilog='注意：解密时会自动识别容器格式的文件。'
+                                       '没有指定输入文件时从标准输入读取，并写到标准输出，'
+                                       '例如 tar c dir | simple_crypto -e | zstd > out'
+                                )
+
+    argp.add_argument('-f', default='-', help='指定输入文件，默认为标准输入。指定目录时处理其中的所有文件')
+    argp.add_argument('-of', help='指定输出文件，“-”为标准输出。输入为目录时为输出目录')
+    argp.add_argument('-e', action='store_true', help='执行加密操作')
+    argp.add_argument('-d', action='store_true', help='执行解密操作')
+    argp.add_argument('-t', default='base64', choices=sorted(crypto_type_map), help='指定加密类型')
+    argp.add_argument('-k', help='指定密钥文件，内容为十六进制的密钥，用于aes-gcm和chacha20-poly1305')
+    argp.add_argument('-bs', type=int, help='指定块大小，base64类型下为9的倍数时解密最快')
+    argp.add_argument('-w', default=os.cpu_count(), type=int, help='指定worker的数量')
+    argp.add_argument('--transport', default='queue', choices=['queue', 'shm'], help='指定数据块的传输方式')
+    argp.add_argument('--container', action='store_true', help='加密时输出可随机访问的容器格式')
+    argp.add_argument('--framing', default='text', choices=['text', 'binary'], help='指定数据块的分帧方式，加密和解密时须一致')
+    argp.add_argument('--armor', action='store_true', help='对binary分帧的输出整段做base64，加密和解密时须一致')
+    argp.add_argument('-c', choices=sorted(Compressor.ALGORITHMS), help='加密前逐块压缩，加密和解密时须一致，容器格式解密时可省略')
+    argp.add_argument('--output-mode', default='auto', choices=['auto', 'ordered', 'pwrite'], help='指定输出方式')
+    argp.add_argument('--max-inflight', type=int, help='同时处理中的数据块数量上限，从标准输入读取时默认为worker数量的16倍')
+    argp.add_argument('--range', help='仅解密明文中的一段，格式为“起始偏移:长度”，仅适用于容器格式')
+    argp.add_argument('--engine', default='auto', choices=['auto', 'inline', 'threads', 'processes'], help='指定执行方式，auto根据输入大小选择')
+    argp.add_argument('--progress', type=float, metavar='SECONDS', help='每隔SECONDS秒在标准错误输出一行进度')
+    argp.add_argument('--stats', metavar='FILE', help='结束时把各阶段的统计以JSON写入FILE，“-”为标准错误')
+    argp.add_argument('--checkpoint', action='store_true', help='定期把写入进度记入输出文件旁的.journal日志，中断后可以续传')
+    argp.add_argument('--resume', action='store_true', help='从.journal日志记录的进度继续，参数须与中断前一致')
+    argp.add_argument('--merkle', action='store_true', help='加密时计算每个数据块的hash，在输出文件旁保存.merkle清单')
+    argp.add_argument('--verify', action='store_true', help='按.merkle清单并行校验加密文件，不需要密钥')
+    argp.add_argument('--manifest', help='指定校验时使用的清单，默认为输入文件旁的.merkle')
+    args = argp.parse_args()
+
+    ## 一些参数验证，标准输出可能是数据，提示信息一律写到标准错误
+    if args.verify:
+        if args.e or args.d:
+            print('有错误的参数，--verify不应该与加密和解密选项同时出现', file=sys.stderr)
+            sys.exit(1)
+        try:
+            root = verify(args.f,
+                          manifest_path=args.manifest,
+                          workers=args.w,
+                          engine=args.engine,
+                          progress=args.progress)
+        except (ValueError, OSError) as e:
+            print(e, file=sys.stderr)
+            sys.exit(1)
+        print(root.hex())
+        sys.exit(0)
+
+    if args.e and args.d:
+        print('有错误的参数，加密和解密选项不应该同时出现', file=sys.stderr)
+        sys.exit(1)
+    elif not(args.e or args.d):
+        print('请指定操作类型', file=sys.stderr)
+        sys.exit(1)
+    if args.merkle and not args.e:
+        print('--merkle只能用于加密操作', file=sys.stderr)
+        sys.exit(1)
+
+    plain_range = None
+    if args.range:
+        if not args.d:
+            print('--range只能用于解密操作', file=sys.stderr)
+            sys.exit(1)
+        try:
+            start, length = (int(i) for i in args.range.split(':'))
+        except ValueError:
+            print('--range的格式应为“起始偏移:长度”', file=sys.stderr)
+            sys.exit(1)
+        plain_range = (start, length)
+
+    crypto_kwargs = {}
+    if args.k:
+        crypto_kwargs['key_file'] = args.k
+
+    opt_type = 'encrypt' if args.e else 'decrypt'
+
+    # 输入为目录时，所有文件共用同一组worker，输出保持同样的目录结构
+    if os.path.isdir(args.f):
+        if plain_range or args.checkpoint or args.resume or args.merkle:
+            print('处理目录时不支持--range、--checkpoint、--resume和--merkle', file=sys.stderr)
+            sys.exit(1)
+        output_dir = args.of or args.f.rstrip(os.sep) + '.scoutput'
+        try:
+            m = BatchMaster(args.t,
+                            opt_type=opt_type,
+                            bs=args.bs,
+                            container=args.container,
+                            framing=args.framing,
+                            armor=args.armor,
+                            compression=args.c,
+                            **crypto_kwargs)
+            summary = m.start(walk_tree(args.f, output_dir),
+                              workers=args.w,
+                              engine=args.engine,
+                              max_inflight=args.max_inflight,
+                              progress=args.progress)
+        except ValueError as e:
+            print(e, file=sys.stderr)
+            sys.exit(1)
+        except RuntimeError as e:
+            for source_path, error in m.failures:
+                print('%s: %s' % (source_path, error), file=sys.stderr)
+            print(e, file=sys.stderr)
+            sys.exit(1)
+        write_stats(args.stats, summary)
+        sys.exit(0)
+
+    try:
+        m = Master(args.f,
+                   args.t,
+                   opt_type=opt_type,
+                   output_file_path=args.of,
+                   bs=args.bs,
+                   container=args.container,
+                   plain_range=plain_range,
+                   framing=args.framing,
+                   armor=args.armor,
+                   compression=args.c,
+                   checkpoint=args.checkpoint,
+                   resume=args.resume,
+                   merkle=args.merkle,
+                   **crypto_kwargs)
+        summary = m.start(workers=args.w,
+                          transport=args.transport,
+                          output_mode=args.output_mode,
+                          max_inflight=args.max_inflight,
+                          engine=args.engine,
+                          progress=args.progress)
+    except ValueError as e:
+        print(e, file=sys.stderr)
+        sys.exit(1)
+    write_stats(args.stats, summary)
@@ -0,0 +1,229 @@
+#!/usr/bin/env python3
+#coding:utf-8
+import os
+import csv
+import sys
+import json
+import time
+import random
+import platform
+import argparse
+import resource
+import tempfile
+import itertools
+from multiprocessing import Process, Queue, active_children
+
+from simple_crypto import Master
+
+
+'''
+simple_crypto的吞吐量测试
+
+生成可压缩和随机两种内容的测试文件，对块大小、worker数量、加密类型、传输方式、
+执行方式和输出方式的每一种组合，先加密再解密，记录吞吐量(MB/s)、master和worker的峰值
+内存以及CPU利用率。结果可以另存为CSV或JSON，便于在版本之间比较。
+
+Master会根据情况换用别的方式，例如pwrite和线程都用不到shm，
+因此结果中另外记下每次运行实际使用的执行方式、传输方式和输出方式。
+默认的输出方式为ordered，加密时不会换成pwrite，比较传输方式时才有意义。
+'''
+
+
+SIZE_UNITS = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+
+# 可压缩内容由这些单词随机拼成的行组成，接近日志一类的文本
+WORDS = [b'alpha', b'beta', b'gamma', b'delta', b'error', b'info', b'warning',
+         b'request', b'response', b'user', b'session', b'timeout', b'0', b'1',
+         b'200', b'404', b'500', b'GET', b'POST', b'/index.html', b'/api/v1']
+
+FIELDS = ['data', 'size', 'crypto_type', 'compression', 'bs', 'workers',
+          'transport', 'engine', 'output_mode', 'opt_type',
+          'actual_transport', 'actual_engine', 'actual_output_mode',
+          'seconds', 'mb_per_s', 'master_rss_mb', 'worker_rss_mb', 'cpu_percent']
+
+
+def parse_size(text):
+    ''' “64”、“64M”、“10G”，不带单位时为MB '''
+    unit = text[-1:].upper()
+    if unit in SIZE_UNITS:
+        return int(float(text[:-1]) * SIZE_UNITS[unit])
+    return int(text) * SIZE_UNITS['M']
+
+
+def make_source(path, kind, size, seed=0):
+    ''' 按固定的种子生成测试文件，同样的参数每次生成同样的内容 '''
+    rng = random.Random(seed)
+    chunk_size = 1024 ** 2
+    if kind == 'compressible':
+        # 生成速度比加密慢得多，先生成16个不同的块再轮流写入
+        chunks = []
+        for i in range(16):
+            lines = []
+            length = 0
+            while length < chunk_size:
+                line = b' '.join(rng.choices(WORDS, k=12)) + b'\n'
+                lines.append(line)
+                length += len(line)
+            chunks.append(b''.join(lines)[:chunk_size])
+        chunks = itertools.cycle(chunks)
+    else: # kind == 'random'
+        chunks = None
+
+    with open(path, 'wb') as f:
+        remain = size
+        while remain > 0:
+            chunk = next(chunks) if chunks is not None else rng.randbytes(chunk_size)
+            f.write(chunk[:remain])
+            remain -= chunk_size
+
+
+def run_case(result_queue, source_file_path, output_file_path, crypto_type, opt_type, master_kwargs, start_kwargs):
+    started = time.perf_counter()
+    summary = Master(source_file_path,
+                     crypto_type,
+                     opt_type=opt_type,
+                     output_file_path=output_file_path,
+                     **master_kwargs).start(**start_kwargs)
+    elapsed = time.perf_counter() - started
+    # worker在收到结束标记后自行退出，回收之后才计入RUSAGE_CHILDREN
+    for worker in active_children():
+        worker.join()
+
+    # 在新进程中运行，SELF是master的峰值，CHILDREN是已经退出的worker中最大的峰值
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    result_queue.put({
+            'transport': summary['transport'],
+            'engine': summary['engine'],
+            'output_mode': summary['output_mode'],
+            'seconds': elapsed,
+            'master_rss_mb': own.ru_maxrss / 1024,
+            'worker_rss_mb': children.ru_maxrss / 1024,
+            'cpu_seconds': own.ru_utime + own.ru_stime + children.ru_utime + children.ru_stime,
+            })
+
+
+def measure(source_file_path, output_file_path, crypto_type, opt_type, master_kwargs, start_kwargs):
+    ''' 每次测量都在一个新进程中进行，峰值内存不受之前的测量影响 '''
+    result_queue = Queue()
+    p = Process(target=run_case,
+                args=(result_queue, source_file_path, output_file_path,
+                      crypto_type, opt_type, master_kwargs, start_kwargs))
+    p.start()
+    p.join()
+    if p.exitcode != 0:
+        raise RuntimeError('%s %s exited with %d' % (crypto_type, opt_type, p.exitcode))
+    return result_queue.get()
+
+
+def bench_cipher(crypto_type, workers, source_file_path, bs, transport='queue', engine='auto',
+                 output_mode='ordered', data='random', **kwargs):
+    ''' 加密再解密一次，返回两行结果 '''
+    size = os.path.getsize(source_file_path)
+    encrypted_file_path = source_file_path + '.' + crypto_type
+    decrypted_file_path = encrypted_file_path + '.decrypted'
+    start_kwargs = {'workers': workers, 'transport': transport, 'engine': engine,
+                    'output_mode': output_mode}
+
+    rows = []
+    for opt_type, input_path, output_path, master_kwargs in [
+            ('encrypt', source_file_path, encrypted_file_path, dict(kwargs, bs=bs)),
+            ('decrypt', encrypted_file_path, decrypted_file_path, kwargs),
+            ]:
+        result = measure(input_path, output_path, crypto_type, opt_type, master_kwargs, start_kwargs)
+        rows.append({
+                'data': data,
+                'size': size,
+                'crypto_type': crypto_type,
+                'compression': kwargs.get('compression') or '',
+                'bs': bs,
+                'workers': workers,
+                'transport': transport,
+                'engine': engine,
+                'output_mode': output_mode,
+                'opt_type': opt_type,
+                'actual_transport': result['transport'],
+                'actual_engine': result['engine'],
+                'actual_output_mode': result['output_mode'],
+                'seconds': round(result['seconds'], 4),
+                'mb_per_s': round(size / result['seconds'] / 1024 ** 2, 1),
+                'master_rss_mb': round(result['master_rss_mb'], 1),
+                'worker_rss_mb': round(result['worker_rss_mb'], 1),
+                # 100%为跑满一个核心
+                'cpu_percent': round(result['cpu_seconds'] / result['seconds'] * 100, 1),
+                })
+
+    os.remove(encrypted_file_path)
+    os.remove(decrypted_file_path)
+    return rows
+
+
+def save_results(path, rows, meta):
+    ''' 按扩展名保存为CSV或JSON，JSON中附带运行环境 '''
+    if path.endswith('.csv'):
+        with open(path, 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=FIELDS)
+            writer.writeheader()
+            writer.writerows(rows)
+    else:
+        with open(path, 'w') as f:
+            json.dump({'meta': meta, 'results': rows}, f, indent=2)
+
+
+if __name__ == '__main__':
+    argp = argparse.ArgumentParser(
+                                prog='simple_crypto_bench',
+                                description='simple_crypto的吞吐量测试'
+                                )
+
+    argp.add_argument('-t', nargs='+', default=['aes-gcm', 'chacha20-poly1305'], help='指定加密类型')
+    argp.add_argument('-w', nargs='+', type=int, help='指定worker的数量，默认为1到CPU核数')
+    argp.add_argument('-bs', nargs='+', default=[64 * 1024], type=int, help='指定块大小')
+    argp.add_argument('-size', nargs='+', default=['64'], help='指定测试文件的大小，可带K、M、G单位，默认单位为MB')
+    argp.add_argument('--data', nargs='+', default=['random'], choices=['random', 'compressible'], help='指定测试文件的内容')
+    argp.add_argument('--transport', nargs='+', default=['queue'], choices=['queue', 'shm'], help='指定数据块的传输方式')
+    argp.add_argument('--engine', nargs='+', default=['processes'], choices=['auto', 'inline', 'threads', 'processes'], help='指定执行方式')
+    argp.add_argument('--output-mode', nargs='+', default=['ordered'], choices=['auto', 'ordered'], help='指定输出方式，auto在加密时可能换成pwrite')
+    argp.add_argument('-c', help='加密前逐块压缩，适合与compressible一起测试')
+    argp.add_argument('--dir', help='测试文件所在的目录，默认为临时目录')
+    argp.add_argument('-o', help='把结果保存到文件，扩展名为.csv时保存为CSV，否则为JSON')
+    args = argp.parse_args()
+
+    workers_list = args.w or range(1, os.cpu_count() + 1)
+    # 所有加密类型共用同一个随机密钥，base64会忽略它
+    key = os.urandom(32)
+    meta = {
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            }
+
+    rows = []
+    with tempfile.TemporaryDirectory(dir=args.dir) as tmp_dir:
+        print('%-12s %8s %-18s %8s %3s %-5s %-9s %-7s %-7s %-25s %10s %8s %8s %6s' % (
+              'data', 'MB', 'crypto_type', 'bs', 'w', 'trans', 'engine', 'output', 'opt',
+              'actual', 'MB/s', 'mRSS MB', 'wRSS MB', 'CPU%'))
+        for data, size_text in itertools.product(args.data, args.size):
+            size = parse_size(size_text)
+            source_file_path = os.path.join(tmp_dir, 'source')
+            make_source(source_file_path, data, size)
+
+            for crypto_type, bs, workers, transport, engine, output_mode in itertools.product(
+                    args.t, args.bs, workers_list, args.transport, args.engine, args.output_mode):
+                for row in bench_cipher(crypto_type, workers, source_file_path, bs,
+                                        transport=transport, engine=engine,
+                                        output_mode=output_mode, data=data,
+                                        key=key, compression=args.c):
+                    rows.append(row)
+                    actual = '%s/%s/%s' % (row['actual_engine'], row['actual_transport'],
+                                           row['actual_output_mode'])
+                    print('%-12s %8.1f %-18s %8d %3d %-5s %-9s %-7s %-7s %-25s %10.1f %8.1f %8.1f %6.1f' % (
+                          data, size / 1024 ** 2, crypto_type, bs, workers, transport, engine,
+                          output_mode, row['opt_type'], actual, row['mb_per_s'],
+                          row['master_rss_mb'], row['worker_rss_mb'], row['cpu_percent']))
+                    sys.stdout.flush()
+            os.remove(source_file_path)
+
+    if args.o:
+        save_results(args.o, rows, meta)
@@ -1,19 +1,133 @@
 #!/usr/bin/env python3
 #coding:utf-8
+import os
 import sys
+import struct
+import hashlib
 import argparse
+import itertools
 
 from base64 import b64encode, b64decode
+from threading import Lock
+from collections import OrderedDict, deque
+from queue import Empty
+from multiprocessing import Pool, Process, Queue
 from Crypto.PublicKey import RSA
-from Crypto.Cipher import PKCS1_OAEP
+from Crypto.Cipher import PKCS1_OAEP, AES
 from Crypto.Hash import SHA512
+from Crypto.Random import get_random_bytes
+
+
+class ParsedKey(object):
+    ''' 解析好的密钥和对应的OAEP对象
+
+    PKCS1_OAEP的加解密不修改对象自身的状态，可以在线程之间共享。
+    fingerprint是公钥DER编码的SHA256，公钥和私钥得到的结果相同
+    '''
+
+    def __init__(self, key_text):
+        if isinstance(key_text, str):
+            key_text = key_text.encode('utf-8')
+        self.key = RSA.importKey(key_text)
+        self.cipher = PKCS1_OAEP.new(self.key, hashAlgo=SHA512)
+        self.fingerprint = hashlib.sha256(self.key.publickey().exportKey('DER')).digest()
+        # 密文的长度，以及每次OAEP最多能加密的字节数
+        self.size = self.key.size_in_bytes()
+        self.max_message = self.size - 2 * SHA512.digest_size - 2
+
+
+class KeyRing(object):
+    ''' 进程内共享的ParsedKey缓存，有上限，满了以后淘汰最久没有用过的
+
+    以密钥文本的SHA256查找，命中时不需要再解析PEM
+    '''
+
+    def __init__(self, maxsize=64):
+        self.maxsize = maxsize
+        self.__keys = OrderedDict()
+        self.__lock = Lock()
+
+    def __len__(self):
+        return len(self.__keys)
+
+    def get(self, key_text):
+        if isinstance(key_text, str):
+            key_text = key_text.encode('utf-8')
+        ident = hashlib.sha256(key_text).digest()
+        with self.__lock:
+            parsed = self.__keys.get(ident)
+            if parsed is not None:
+                self.__keys.move_to_end(ident)
+                return parsed
+
+        # 在锁外解析，不阻塞其他线程查找，偶尔重复解析同一个密钥也没有关系
+        parsed = ParsedKey(key_text)
+        with self.__lock:
+            self.__keys[ident] = parsed
+            self.__keys.move_to_end(ident)
+            while len(self.__keys) > self.maxsize:
+                self.__keys.popitem(last=False)
+        return parsed
+
+    def clear(self):
+        with self.__lock:
+            self.__keys.clear()
+
+
+keyring = KeyRing()
+
+# 由start_key_pool设置，没有给出密钥的SimpleRsa()从中取预先生成的密钥对
+key_pool = None
+
+
+# 解密进程池中每个进程持有的私钥，由init_decrypt_worker在进程启动时解析一次
+decrypt_key = None
+
+
+def init_decrypt_worker(private_key):
+    global decrypt_key
+    decrypt_key = keyring.get(private_key)
+
+
+def decrypt_blocks(data):
+    ''' 解密首尾相接的若干块密文 '''
+    view = memoryview(data)
+    return b''.join(decrypt_key.cipher.decrypt(view[i: i + decrypt_key.size])
+                    for i in range(0, len(data), decrypt_key.size))
+
 
 class SimpleRsa(object):
-    def __init__(self, public_key=None, private_key=None):
+    # 信封格式：随机生成一个AES-GCM数据密钥，用RSA-OAEP只加密这个密钥一次，
+    # 数据按SEGMENT_SIZE分段用数据密钥加密
+    #   MAGIC | 版本(u8) | 加密后的数据密钥长度(u16) | 加密后的数据密钥 | 分段...
+    # 有多个接收者时数据仍只加密一次，用每个接收者的公钥各加密一份数据密钥，
+    # 解密时按公钥的指纹找到自己的那一份
+    #   MAGIC | RECIPIENTS_VERSION(u8) | 接收者数量(u16) | (指纹 | 长度(u16) | 加密后的数据密钥)... | 分段...
+    # 每段为 密文 | tag，nonce由段序号和是否最后一段组成，头部作为附加数据参与认证。
+    # 文本形式为ENVELOPE_PREFIX加上整个信封的base64，分块格式是纯base64，不会以它开头。
+    # 分块格式每块单独用RSA-OAEP加密，二进制形式为 BLOCKS_MAGIC | 版本(u8) | 各块密文
+    ENVELOPE_MAGIC = b'SRE'
+    ENVELOPE_VERSION = 1
+    RECIPIENTS_VERSION = 2
+    FINGERPRINT_SIZE = 32
+    ENVELOPE_PREFIX = 'SRE:'
+    BLOCKS_MAGIC = b'SRB'
+    BLOCKS_VERSION = 1
+    DATA_KEY_SIZE = 32
+    SEGMENT_SIZE = 64 * 1024
+    TAG_SIZE = 16
+    # 多进程解密时每个任务包含的块数
+    POOL_BATCH_BLOCKS = 64
+
+    def __init__(self, public_key=None, private_key=None, keyring=keyring):
         if not (public_key or private_key):
-            public_key, private_key = self.rsa_key_gen()
+            if key_pool is not None:
+                public_key, private_key = key_pool.get()
+            else:
+                public_key, private_key = self.rsa_key_gen()
         self.public_key = public_key
         self.private_key = private_key
+        self.keyring = keyring
 
     @classmethod
     def rsa_key_gen(cls, length=2048):
@@ -22,40 +136,381 @@ class SimpleRsa(object):
         public = seed.publickey().exportKey('PEM').decode('utf-8')
         return public, private
 
+    @classmethod
+    def rsa_key_gen_many(cls, count, length=2048, workers=None):
+        ''' 用多个进程并行生成count对密钥 '''
+        workers = min(workers or os.cpu_count(), count)
+        if workers <= 1:
+            return [cls.rsa_key_gen(length) for i in range(count)]
+        with Pool(workers) as pool:
+            return pool.map(cls.rsa_key_gen, [length] * count, chunksize=1)
+
     def rsa_encode(self, public_key, data):
-        the_key = RSA.importKey(public_key.encode('utf-8'))
-        clp = PKCS1_OAEP.new(the_key, hashAlgo=SHA512)
-        return clp.encrypt(data)
+        return self.keyring.get(public_key).cipher.encrypt(data)
 
     def rsa_decode(self, private_key, data):
-        the_key = RSA.importKey(private_key.encode('utf-8'))
-        clp = PKCS1_OAEP.new(the_key, hashAlgo=SHA512)
-        return clp.decrypt(data)
+        return self.keyring.get(private_key).cipher.decrypt(data)
 
-    def encode_data(self, data, public_key=None):
+    @classmethod
+    def segment_cipher(cls, data_key, header, serial, last):
+        nonce = struct.pack('>3xBQ', last, serial)
+        cipher = AES.new(data_key, AES.MODE_GCM, nonce=nonce, mac_len=cls.TAG_SIZE)
+        cipher.update(header)
+        return cipher
+
+    def iter_envelope_encrypt(self, segments, public_key=None, recipients=None):
+        ''' 逐段加密为信封，segments中除最后一段外都须为SEGMENT_SIZE
+
+        recipients为公钥的列表时忽略public_key，每个接收者都可以用自己的私钥解密
+        '''
         if not public_key:
             public_key = self.public_key
 
-        blocks = [data[i: i+5] for i in range(0, len(data), 5)]
-        res = str()
-        for block in blocks:
-            encoded = self.rsa_encode(public_key, block.encode())
-            b64data = b64encode(encoded).decode()
-            res += b64data
-        return res
+        data_key = get_random_bytes(self.DATA_KEY_SIZE)
+        if recipients:
+            if len(recipients) > 0xffff:
+                raise ValueError('too many recipients')
+            header = [self.ENVELOPE_MAGIC, struct.pack('>BH', self.RECIPIENTS_VERSION, len(recipients))]
+            for recipient in recipients:
+                wrapped_key = self.rsa_encode(recipient, data_key)
+                header += [self.keyring.get(recipient).fingerprint,
+                           struct.pack('>H', len(wrapped_key)),
+                           wrapped_key]
+            header = b''.join(header)
+        else:
+            wrapped_key = self.rsa_encode(public_key, data_key)
+            header = (self.ENVELOPE_MAGIC
+                      + struct.pack('>BH', self.ENVELOPE_VERSION, len(wrapped_key))
+                      + wrapped_key)
+        yield header
+
+        # 预读一段才知道当前段是不是最后一段。空数据也输出一段，解密时才能确认数据没有被截断
+        segments = iter(segments)
+        segment = next(segments, b'')
+        for serial in itertools.count():
+            following = next(segments, None)
+            cipher = self.segment_cipher(data_key, header, serial, following is None)
+            encrypted, tag = cipher.encrypt_and_digest(segment)
+            yield encrypted
+            yield tag
+            if following is None:
+                return
+            segment = following
 
-    def decode_data(self, data, private_key=None):
+    def iter_envelope_decrypt(self, pieces, private_key=None):
+        ''' 逐段解密信封，pieces的长度任意，数据被改动或截断时抛出ValueError '''
         if not private_key:
             private_key = self.private_key
 
-        blocks = [data[i: i+344] for i in range(0, len(data), 344)]
-        res = str()
-        for block in blocks:
-            b64decoded_data = b64decode(block.rstrip('\n'))
-            decoded = self.rsa_decode(private_key, b64decoded_data)
-            res += decoded.decode('utf-8')
-        return res
+        segment_size = self.SEGMENT_SIZE + self.TAG_SIZE
+        buffer_ = bytearray()
+        header = None
+        serial = 0
+        for piece in pieces:
+            buffer_ += piece
+            if header is None:
+                parsed = self.__parse_header(buffer_)
+                if parsed is None:
+                    continue
+                header, wrapped_keys = parsed
+                data_key = self.__unwrap_key(wrapped_keys, private_key)
+                del buffer_[:len(header)]
+
+            # 缓存中多于一段时，第一段一定不是最后一段
+            while len(buffer_) > segment_size:
+                yield self.__open_segment(data_key, header, serial, memoryview(buffer_)[:segment_size], False)
+                del buffer_[:segment_size]
+                serial += 1
+
+        if header is None:
+            raise ValueError('envelope header is truncated')
+        yield self.__open_segment(data_key, header, serial, memoryview(buffer_), True)
+
+    def __parse_header(self, buffer_):
+        ''' 缓存中已有完整的头部时，返回头部和其中的(指纹, 加密后的数据密钥)列表，否则返回None '''
+        magic_size = len(self.ENVELOPE_MAGIC)
+        if buffer_[:magic_size] != self.ENVELOPE_MAGIC[:len(buffer_)]:
+            raise ValueError('not an envelope')
+        offset = magic_size + 3
+        if len(buffer_) < offset:
+            return None
+        version, size = struct.unpack('>BH', buffer_[magic_size: offset])
+
+        if version == self.ENVELOPE_VERSION:
+            # 只有一个接收者，没有指纹
+            if len(buffer_) < offset + size:
+                return None
+            return bytes(buffer_[:offset + size]), [(None, bytes(buffer_[offset: offset + size]))]
+        if version != self.RECIPIENTS_VERSION:
+            raise ValueError('unsupported envelope version %d' % version)
+
+        wrapped_keys = []
+        for i in range(size):
+            if len(buffer_) < offset + self.FINGERPRINT_SIZE + 2:
+                return None
+            fingerprint = bytes(buffer_[offset: offset + self.FINGERPRINT_SIZE])
+            offset += self.FINGERPRINT_SIZE
+            wrapped_size, = struct.unpack('>H', buffer_[offset: offset + 2])
+            offset += 2
+            if len(buffer_) < offset + wrapped_size:
+                return None
+            wrapped_keys.append((fingerprint, bytes(buffer_[offset: offset + wrapped_size])))
+            offset += wrapped_size
+        return bytes(buffer_[:offset]), wrapped_keys
+
+    def __unwrap_key(self, wrapped_keys, private_key):
+        fingerprint = self.keyring.get(private_key).fingerprint
+        for key_fingerprint, wrapped_key in wrapped_keys:
+            if key_fingerprint is None or key_fingerprint == fingerprint:
+                return self.rsa_decode(private_key, wrapped_key)
+        raise ValueError('the private key is not one of the recipients')
+
+    def __open_segment(self, data_key, header, serial, segment, last):
+        if len(segment) < self.TAG_SIZE:
+            raise ValueError('segment %d is truncated' % serial)
+        cipher = self.segment_cipher(data_key, header, serial, last)
+        try:
+            return cipher.decrypt_and_verify(segment[:-self.TAG_SIZE], segment[-self.TAG_SIZE:])
+        except ValueError:
+            raise ValueError('segment %d failed authentication' % serial)
 
+    def envelope_encrypt(self, data, public_key=None, recipients=None):
+        ''' 把bytes加密为二进制的信封 '''
+        view = memoryview(data)
+        segments = (view[offset: offset + self.SEGMENT_SIZE]
+                    for offset in range(0, len(data), self.SEGMENT_SIZE))
+        return b''.join(self.iter_envelope_encrypt(segments, public_key, recipients))
+
+    def envelope_decrypt(self, data, private_key=None):
+        ''' 解密二进制的信封，数据被改动或截断时抛出ValueError '''
+        return b''.join(self.iter_envelope_decrypt([data], private_key))
+
+    def iter_rsa_encrypt(self, chunks, public_key):
+        ''' 分块格式：按密钥长度把尽量多的字节装进每次OAEP加密，产出各块的密文 '''
+        parsed = self.keyring.get(public_key)
+        # 密钥太短时一个字节也装不下，不能让iter_fixed把数据全部丢掉
+        # 在返回生成器之前检查，调用时就抛出，不会先写出文件头
+        if parsed.max_message < 1:
+            raise ValueError('%d-bit key is too small for OAEP with SHA512' % (parsed.size * 8))
+        return (parsed.cipher.encrypt(block) for block in iter_fixed(chunks, parsed.max_message))
+
+    def iter_rsa_decrypt(self, blocks, private_key, workers=1):
+        ''' 每块密文的长度与密钥的模长相同，和加密时每块装了多少字节无关，
+        因此也能解密以前每5个字符一块的文件
+
+        workers大于1时按POOL_BATCH_BLOCKS块一批分给进程池，按顺序产出各批的结果
+        '''
+        parsed = self.keyring.get(private_key)
+        batches = iter_fixed(blocks, parsed.size * self.POOL_BATCH_BLOCKS)
+        head = list(itertools.islice(batches, 2))
+        batches = itertools.chain(head, batches)
+        # 不到两批时启动进程池不划算
+        if workers <= 1 or len(head) < 2:
+            for batch in batches:
+                for block in iter_fixed([batch], parsed.size):
+                    yield parsed.cipher.decrypt(block)
+            return
+
+        pool = Pool(workers, initializer=init_decrypt_worker, initargs=(private_key, ))
+        try:
+            # 最多有workers的两倍批在处理中，内存占用与数据大小无关
+            pending = deque()
+            for batch in batches:
+                pending.append(pool.apply_async(decrypt_blocks, (bytes(batch), )))
+                if len(pending) >= workers * 2:
+                    yield pending.popleft().get()
+            while pending:
+                yield pending.popleft().get()
+        finally:
+            pool.terminate()
+
+    def iter_rsa_decrypt_text(self, pieces, private_key, workers=1):
+        ''' 文本形式的分块格式是各块密文分别做base64后首尾相接 '''
+        text_size = -(-self.keyring.get(private_key).size // 3) * 4
+        blocks = (b64decode(block)
+                  for block in iter_fixed((bytes(piece).translate(None, b'\r\n') for piece in pieces),
+                                          text_size))
+        return self.iter_rsa_decrypt(blocks, private_key, workers)
+
+    def encode_data(self, data, public_key=None, envelope=False, recipients=None):
+        if not public_key:
+            public_key = self.public_key
+
+        # 多个接收者只能用信封格式
+        if envelope or recipients:
+            encoded = self.envelope_encrypt(data.encode(), public_key, recipients)
+            return self.ENVELOPE_PREFIX + b64encode(encoded).decode()
+        return b''.join(b64encode(block)
+                        for block in self.iter_rsa_encrypt([data.encode()], public_key)).decode()
+
+    def decode_data(self, data, private_key=None, workers=1):
+        if not private_key:
+            private_key = self.private_key
+
+        if data.startswith(self.ENVELOPE_PREFIX):
+            encoded = b64decode(data[len(self.ENVELOPE_PREFIX):].rstrip('\n'))
+            return self.envelope_decrypt(encoded, private_key).decode('utf-8')
+        return b''.join(self.iter_rsa_decrypt_text([data.encode()], private_key, workers)).decode('utf-8')
+
+    def encode_stream(self, in_fp, out_fp, public_key=None, envelope=False, binary=False, recipients=None):
+        ''' 从二进制文件in_fp逐段读取并加密，写到二进制文件out_fp
+
+        是生成器，每写出一段产出一次已写出的字节数，占用的内存与文件大小无关。
+        binary为True时不做base64，输出更小。recipients为多个公钥时使用信封格式
+        '''
+        if not public_key:
+            public_key = self.public_key
+
+        chunks = iter_chunks(in_fp, self.SEGMENT_SIZE)
+        if envelope or recipients:
+            encrypted = self.iter_envelope_encrypt(chunks, public_key, recipients)
+            if binary:
+                pieces = encrypted
+            else:
+                pieces = itertools.chain([self.ENVELOPE_PREFIX.encode()], iter_b64encode(encrypted))
+        else:
+            encrypted = self.iter_rsa_encrypt(chunks, public_key)
+            if binary:
+                head = self.BLOCKS_MAGIC + struct.pack('>B', self.BLOCKS_VERSION)
+                pieces = itertools.chain([head], encrypted)
+            else:
+                pieces = (b64encode(block) for block in encrypted)
+        yield from write_stream(pieces, out_fp)
+
+    def decode_stream(self, in_fp, out_fp, private_key=None, workers=1):
+        ''' encode_stream的逆操作，根据开头自动识别格式
+
+        workers大于1时分块格式用多个进程解密，信封格式只有一次RSA操作，不受影响
+        '''
+        if not private_key:
+            private_key = self.private_key
+
+        chunks = iter_chunks(in_fp, self.SEGMENT_SIZE)
+        first = next(chunks, b'')
+        prefix = self.ENVELOPE_PREFIX.encode()
+        if first.startswith(prefix):
+            encoded = itertools.chain([first[len(prefix):]], chunks)
+            pieces = self.iter_envelope_decrypt(iter_b64decode(encoded), private_key)
+        elif self.__is_binary(first, self.ENVELOPE_MAGIC):
+            pieces = self.iter_envelope_decrypt(itertools.chain([first], chunks), private_key)
+        elif self.__is_binary(first, self.BLOCKS_MAGIC):
+            version = first[len(self.BLOCKS_MAGIC)]
+            if version != self.BLOCKS_VERSION:
+                raise ValueError('unsupported block format version %d' % version)
+            encrypted = itertools.chain([first[len(self.BLOCKS_MAGIC) + 1:]], chunks)
+            pieces = self.iter_rsa_decrypt(encrypted, private_key, workers)
+        else:
+            pieces = self.iter_rsa_decrypt_text(itertools.chain([first], chunks), private_key, workers)
+        yield from write_stream(pieces, out_fp)
+
+    @staticmethod
+    def __is_binary(first, magic):
+        # 文本格式只有base64字符，二进制格式的MAGIC之后是不可打印的版本号
+        return first.startswith(magic) and len(first) > len(magic) and first[len(magic)] < 0x20
+
+class KeyPool(object):
+    ''' 在后台进程中预先生成密钥对，备用的满size对后暂停生成
+
+    生成4096位的密钥要几秒，请求处理中需要新密钥时可以直接取走备用的
+    '''
+
+    def __init__(self, size=4, length=2048):
+        self.length = length
+        self.queue = Queue(size)
+        self.process = Process(target=self.fill, args=(self.queue, length), daemon=True)
+        self.process.start()
+
+    @staticmethod
+    def fill(queue, length):
+        while True:
+            queue.put(SimpleRsa.rsa_key_gen(length))
+
+    def get(self):
+        ''' 有备用的密钥对时立即返回，否则当场生成 '''
+        try:
+            return self.queue.get_nowait()
+        except Empty:
+            return SimpleRsa.rsa_key_gen(self.length)
+
+    def close(self):
+        self.process.terminate()
+        self.process.join()
+
+
+def start_key_pool(size=4, length=2048):
+    global key_pool
+    if key_pool is None:
+        key_pool = KeyPool(size, length)
+    return key_pool
+
+
+def stop_key_pool():
+    global key_pool
+    if key_pool is not None:
+        key_pool.close()
+        key_pool = None
+
+
+def iter_chunks(fp, size):
+    ''' 每次读出size字节，只有最后一段可以更短 '''
+    while True:
+        chunk = fp.read(size)
+        while chunk and len(chunk) < size:
+            more = fp.read(size - len(chunk))
+            if not more:
+                break
+            chunk += more
+        if not chunk:
+            return
+        yield chunk
+
+
+def iter_fixed(pieces, size):
+    ''' 把长度任意的pieces重新切成每段size字节，只有最后一段可以更短 '''
+    pending = b''
+    for piece in pieces:
+        pending += piece
+        cut = len(pending) - len(pending) % size
+        view = memoryview(pending)
+        for i in range(0, cut, size):
+            yield view[i: i + size]
+        pending = pending[cut:]
+    if pending:
+        yield pending
+
+
+def iter_b64encode(pieces):
+    ''' 逐段做base64，每次只编码3的整数倍的字节，结果与整段编码相同 '''
+    pending = b''
+    for piece in pieces:
+        pending += piece
+        cut = len(pending) - len(pending) % 3
+        if cut:
+            yield b64encode(memoryview(pending)[:cut])
+            pending = pending[cut:]
+    if pending:
+        yield b64encode(pending)
+
+
+def iter_b64decode(pieces):
+    ''' 逐段解base64，忽略换行，每次只解码4的整数倍的字符 '''
+    pending = b''
+    for piece in pieces:
+        pending += bytes(piece).translate(None, b'\r\n')
+        cut = len(pending) - len(pending) % 4
+        if cut:
+            yield b64decode(memoryview(pending)[:cut])
+            pending = pending[cut:]
+    if pending:
+        yield b64decode(pending)
+
+
+def write_stream(pieces, fp):
+    written = 0
+    for piece in pieces:
+        fp.write(piece)
+        written += len(piece)
+        yield written
 
 def write_down(file_name, data):
     with open(file_name, 'w') as f:
@@ -75,23 +530,33 @@ if __name__ == '__main__':
     argp.add_argument('-of', help='指定输出文件')
     argp.add_argument('-e', action='store_true', help='执行加密操作')
     argp.add_argument('-d', action='store_true', help='执行解密操作')
-    argp.add_argument('-pub', help='指定公钥文件')
+    argp.add_argument('-pub', nargs='+', help='指定公钥文件，指定多个时每个公钥对应的私钥都可以解密')
     argp.add_argument('-pri', help='指定私钥文件')
+    argp.add_argument('-w', default=os.cpu_count(), type=int, help='解密分块格式和批量生成密钥时使用的进程数')
+    argp.add_argument('--envelope', action='store_true', help='加密时使用信封格式：RSA只加密一个随机的AES密钥，数据用AES加密。解密时自动识别')
+    argp.add_argument('--binary', action='store_true', help='加密文件时直接输出二进制，不做base64。解密时自动识别')
     argp.add_argument('--key-gen', action='store_true', help='生成一对密钥并退出程序')
     argp.add_argument('--key-len', default=2048, type=int, help='指定生成密钥的长度')
+    argp.add_argument('--count', default=1, type=int, help='与--key-gen一起使用，用-w个进程并行生成多对密钥，文件名中加上序号')
     argp.add_argument('-opub', default='simple_rsa.pub', help='指定输出的公钥文件名')
     argp.add_argument('-opri', default='simple_rsa.pri', help='指定输出的私钥文件名')
     args = argp.parse_args()
 
     ## 执行--key-gen并退出
     if args.key_gen:
-        pub, pri = SimpleRsa.rsa_key_gen(length=args.key_len)
-        if args.print:
-            print(pub)
-            print(pri)
-        else:
-            write_down(args.opub, pub)
-            write_down(args.opri, pri)
+        key_pairs = SimpleRsa.rsa_key_gen_many(args.count, length=args.key_len, workers=args.w)
+        for i, (pub, pri) in enumerate(key_pairs):
+            if args.print:
+                print(pub)
+                print(pri)
+            elif args.count == 1:
+                write_down(args.opub, pub)
+                write_down(args.opri, pri)
+            else:
+                # simple_rsa.pub -> simple_rsa.1.pub
+                for file_name, key in [(args.opub, pub), (args.opri, pri)]:
+                    root, ext = os.path.splitext(file_name)
+                    write_down('%s.%d%s' % (root, i + 1, ext), key)
         sys.exit()
 
     ## 一些参数验证
@@ -108,10 +573,16 @@ if __name__ == '__main__':
     ## 获取密钥并初始化
     public_key = None
     private_key = None
-    # 加密操作读取公钥
+    recipients = None
+    # 加密操作读取公钥，多个公钥时数据只加密一次
     if args.pub and args.e:
-        with open(args.pub, 'r') as f:
-            public_key = f.read()
+        public_keys = []
+        for file_name in args.pub:
+            with open(file_name, 'r') as f:
+                public_keys.append(f.read())
+        public_key = public_keys[0]
+        if len(public_keys) > 1:
+            recipients = public_keys
         sr = SimpleRsa(public_key=public_key)
     else:
         sr = SimpleRsa()
@@ -134,43 +605,57 @@ if __name__ == '__main__':
         sr = SimpleRsa(private_key=private_key)
 
     ## 获取数据
-    data = None
     if not (args.data or args.f):
         print('没有需要加密的内容')
+        sys.exit()
+
+    output_file_name = args.of
+    if not output_file_name:
+        if args.data:
+            output_file_name = 'simple_rsa_output.rsb64'
+        elif args.e:
+            output_file_name = args.f + '.srb64'
+        elif args.f.endswith('.srb64'):
+            output_file_name = args.f[:-len('.srb64')]
+        else:
+            output_file_name = args.f + '.decoded'
+    title = '\n加密后的数据：' if args.e else '\n解密后的数据：'
+
+    ## 直接以参数提供的数据一次性处理
     if args.data:
-        data = args.data
-    if not data:
-        with open(args.f, 'r') as f:
-            data = f.read()
-    if not data:
-        print('没有需要加密的内容')
+        if args.e:
+            res = sr.encode_data(args.data, envelope=args.envelope, recipients=recipients)
+        else:
+            res = sr.decode_data(args.data, workers=args.w)
+        if args.print:
+            print(title)
+            print(res)
+        else:
+            write_down(output_file_name, res)
         sys.exit()
 
-    ## 执行加密操作
-    if args.e:
-        encoded_data = sr.encode_data(data)
+    ## 文件逐段读取和写出，占用的内存与文件大小无关
+    if os.path.isfile(args.f) and not os.path.getsize(args.f):
+        print('没有需要加密的内容')
+        sys.exit()
+    with open(args.f, 'rb') as in_fp:
         if args.print:
-            print('\n加密后的数据：')
-            print(encoded_data)
+            print(title)
+            sys.stdout.flush()
+            out_fp = sys.stdout.buffer
+        else:
+            out_fp = open(output_file_name, 'wb')
+        if args.e:
+            stream = sr.encode_stream(in_fp, out_fp,
+                                      envelope=args.envelope,
+                                      binary=args.binary,
+                                      recipients=recipients)
         else:
-            if args.f and not args.of:
-                encoded_file_name = args.f + '.srb64'
-            if args.data and not args.of:
-                encoded_file_name = 'simple_rsa_output.rsb64'
-            write_down(encoded_file_name, encoded_data)
-
-    ## 执行解密操作
-    if args.d:
-        decoded_data = sr.decode_data(data)
+            stream = sr.decode_stream(in_fp, out_fp, workers=args.w)
+        for written in stream:
+            pass
         if args.print:
-            print('\n解密后的数据：')
-            print(decoded_data)
+            out_fp.write(b'\n')
+            out_fp.flush()
         else:
-            if args.f and not args.of:
-                if args.f.endswith('.rsb64'):
-                    decoded_file_name = args.f.rstrip('.srb64')
-                else:
-                    decoded_file_name = args.f + '.decoded'
-            if args.data and not args.of:
-                decoded_file_name = 'simple_rsa_output.rsb64'
-            write_down(decoded_file_name, decoded_data)
+            out_fp.close()